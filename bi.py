@@ -8,6 +8,24 @@ import os
 import io
 import time
 import argparse
+import mmap
+import stat
+import ast
+import tempfile
+import bisect
+import collections
+import itertools
+import math
+import operator
+import contextlib
+import codecs
+import select
+import struct
+import hashlib
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python 3.10 以前
+    import sre_parse
 
 # ========================================================================
 # readline フォールバック実装 (C版の #ifndef HAVE_READLINE から移植)
@@ -68,18 +86,441 @@ except ImportError:
 
 
 
+# ========================================================================
+# ピーステーブル: 編集バッファの実体
+# ========================================================================
+_PIECE_LEN = operator.itemgetter(2)    # ピース (buf, off, length) の長さ
+
+
+class PieceTable:
+    """ピーステーブル方式のバイト列。
+
+    読み込んだ元データ(読み取り専用)と追記専用の add バッファの2つを持ち、
+    バッファ本体は「どちらのバッファの何バイト目から何バイト」を表すピース
+    (buf, off, length) の列で表現する。挿入・削除・上書きはピース列の分割と
+    差し替えだけで済み、bytearray のスライス代入のように編集位置以降の
+    全データを移動しない。ピース列は最大 BLOCK 個ずつのブロックに分けて
+    持ち、位置の検索はブロック単位の開始位置表 + ブロック内の走査で行う
+    ので、1回の編集・参照のコストは全ピース数ではなくブロック数と
+    BLOCK に比例する(散らばった編集を続けてもピース数の2乗にならない)。
+
+    mem[i], mem[a:b], len(mem), mem[i] = v, mem[a:b] = data, del mem[a:b],
+    mem += data などは bytearray と同じ感覚で使える。スライスの読み出しは
+    bytes を返す。@exec / {}eval のコードが mem を参照するときは、bytes の
+    メソッドやバッファプロトコルも使えるよう bytearray / bytes に実体化した
+    ものを渡す (BiEditor.call_exec / Parser 参照)。
+
+    元データには読み取り専用の mmap も渡せる。その場合ページは実際に
+    読まれたときに初めてフォールトインされ、変更はすべて add バッファ側
+    (オーバーレイ) に入るため、元ファイルのサイズに関わらず読み込みは
+    一定時間で終わる。
+    """
+    CHUNK = 1 << 20   # iter_chunks() が一度に返す最大バイト数
+    # 編集版数の発番元。全インスタンスで共有するので、ファイルを読み直して
+    # mem が別の PieceTable に差し替わっても版数が過去の値に戻ることはない。
+    _versions = itertools.count(1)
+    EDIT_LOG = 256    # changed_since() で遡れる変更の件数
+    BLOCK = 128       # 1ブロックのピース数の上限
+
+    def __init__(self, data=b''):
+        if not isinstance(data, (bytes, mmap.mmap)):
+            data = bytes(data)
+        self._orig = data
+        self._add = bytearray()
+        self._blocks = [[(data, 0, len(data))]] if len(data) else []  # ピース列のブロック
+        self._blens = [len(data)] if len(data) else []  # 各ブロックのバイト数
+        self._len = len(data)
+        self._bstarts = None    # 各ブロックの論理開始位置 (遅延構築)
+        self._bends = [None] * len(self._blocks)  # ブロック内の各ピースの終了位置 (遅延構築)
+        self._flat = None       # contiguous() のキャッシュ (次の変更まで有効)
+        self.version = next(self._versions)  # 変更のたびに増える編集版数
+        self._edits = []        # (変更前の版数, a, b, 挿入バイト数) の履歴
+
+    # ------------------------------------------------------------------
+    # 内部ヘルパー
+    # ------------------------------------------------------------------
+    def _locate(self, pos):
+        """論理位置 pos (0..len) を含むピースの (ブロック, ブロック内の index,
+        ピース内オフセット) を返す。pos == len のときは (ブロック数, 0, 0)。"""
+        if self._bstarts is None:
+            self._bstarts = list(itertools.accumulate(self._blens, initial=0))
+        k = bisect.bisect_right(self._bstarts, pos) - 1
+        if k >= len(self._blocks):
+            return len(self._blocks), 0, 0
+        o = pos - self._bstarts[k]
+        ends = self._bends[k]
+        if ends is None:
+            ends = self._bends[k] = list(itertools.accumulate(map(_PIECE_LEN, self._blocks[k])))
+        i = bisect.bisect_right(ends, o)
+        return k, i, o - (ends[i - 1] if i else 0)
+
+    def _walk(self, k, i, reverse=False):
+        """ブロック k の i 番目のピースから順に (reverse なら逆順に) ピースを返す"""
+        blocks = self._blocks
+        if reverse:
+            while k >= 0:
+                blk = blocks[k]
+                for x in range(i, -1, -1):
+                    yield blk[x]
+                k -= 1
+                if k >= 0:
+                    i = len(blocks[k]) - 1
+        else:
+            while k < len(blocks):
+                yield from itertools.islice(blocks[k], i, None)
+                k += 1
+                i = 0
+
+    def _splice(self, a, b, data):
+        """[a, b) を data で置き換える。全ての変更操作はここを通る。"""
+        if isinstance(data, PieceTable):
+            data = bytes(data)
+        blocks = self._blocks
+        add = self._add
+        k, i, ia = self._locate(a)
+        kb, j, jb = self._locate(b)
+        # 影響するブロックのピースを1つの列に集めて差し替える。先頭で
+        # 始まるときは連結できるよう直前のピースのブロックも含める。
+        k0 = k - 1 if i == 0 and ia == 0 and k > 0 else k
+        k1 = min(kb, len(blocks) - 1)
+        local = [p for blk in blocks[k0:k1 + 1] for p in blk]
+        lo = i + (len(blocks[k0]) if k0 < k else 0)
+        hi = j + sum(len(blk) for blk in blocks[k0:kb])
+        new = []
+        if ia:
+            buf, off, _ = local[lo]
+            new.append((buf, off, ia))
+        off = len(add)
+        add.extend(data)
+        n = len(add) - off
+        if n:
+            new.append((add, off, n))
+        if jb:
+            buf, off, ln = local[hi]
+            new.append((buf, off + jb, ln - jb))
+            hi += 1
+        # 継ぎ目で同じバッファの続きになったピースは1つにまとめる
+        # (連続した追記・上書き、削除で元の並びに戻った場合など)
+        if lo > 0:
+            lo -= 1
+            new.insert(0, local[lo])
+        if hi < len(local):
+            new.append(local[hi])
+            hi += 1
+        merged = []
+        for p in new:
+            if merged and merged[-1][0] is p[0] and merged[-1][1] + merged[-1][2] == p[1]:
+                buf, o, ln = merged.pop()
+                p = (buf, o, ln + p[2])
+            merged.append(p)
+        local[lo:hi] = merged
+        # 小さくなったら次のブロックと合わせ、大きければ分ける
+        if len(local) < self.BLOCK // 2 and k1 + 1 < len(blocks):
+            k1 += 1
+            local.extend(blocks[k1])
+        m = -(-len(local) // self.BLOCK)
+        new_blocks = [local[x * len(local) // m:(x + 1) * len(local) // m] for x in range(m)]
+        blocks[k0:k1 + 1] = new_blocks
+        self._blens[k0:k1 + 1] = [sum(map(_PIECE_LEN, blk)) for blk in new_blocks]
+        self._bends[k0:k1 + 1] = [None] * m
+        self._len += n - (b - a)
+        self._bstarts = None
+        self._flat = None
+        self._edits.append((self.version, a, b, n))
+        if len(self._edits) > self.EDIT_LOG:
+            del self._edits[0]
+        self.version = next(self._versions)
+
+    def _index(self, key):
+        idx = operator.index(key)
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError('PieceTable index out of range')
+        return idx
+
+    # ------------------------------------------------------------------
+    # 読み出し
+    # ------------------------------------------------------------------
+    def __len__(self):
+        return self._len
+
+    def read(self, start, stop):
+        """[start, stop) を bytes で返す (範囲はバッファ長でクランプ)"""
+        start = max(0, start)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return b''
+        return b''.join(self.iter_chunks(start, stop))
+
+    def contiguous(self):
+        """バッファ全体を1つの連続したバッファとして返す(正規表現のように
+        連続領域を必要とする処理用)。ピースが元データの1つだけなら
+        コピーせずその memoryview を、そうでなければ連結した bytes を返す
+        (連結結果は次の変更までキャッシュする)。add バッファは伸長される
+        ため memoryview では公開しない。"""
+        if len(self._blocks) == 1 and len(self._blocks[0]) == 1 \
+                and self._blocks[0][0][0] is not self._add:
+            buf, off, ln = self._blocks[0][0]
+            return memoryview(buf)[off:off + ln]
+        if self._flat is None:
+            self._flat = self.read(0, self._len)
+        return self._flat
+
+    def tobytes(self):
+        """バッファ全体の bytes。次の変更までキャッシュする
+        ({} 式のように同じ内容を何度も読み返す処理用)。"""
+        if self._flat is None:
+            self._flat = self.read(0, self._len)
+        return self._flat
+
+    def rebase(self, old, new):
+        """元データ old を同じ内容の new に付け替える (old のファイルを
+        書き換える前に、バッファの内容を退避先の new から読むようにする)"""
+        for blk in self._blocks:
+            blk[:] = [(new if buf is old else buf, off, ln) for buf, off, ln in blk]
+        if self._orig is old:
+            self._orig = new
+
+    def snapshot(self):
+        """今の内容を読むための別の PieceTable を、データをコピーせず
+        ピース列だけの複製 (O(ピース数)) で作る。元データは読み取り専用、
+        add バッファは追記しかされないので既存のピースが指す内容は変わらず、
+        以後どちらを変更しても他方には影響しない (スナップショット側の変更は
+        自分専用の add バッファに入る)。"""
+        t = PieceTable.__new__(PieceTable)
+        t._orig = self._orig
+        t._add = bytearray()
+        t._blocks = [list(blk) for blk in self._blocks]
+        t._blens = list(self._blens)
+        t._bends = list(self._bends)
+        t._len = self._len
+        t._bstarts = self._bstarts
+        t._flat = self._flat
+        t.version = self.version
+        t._edits = []
+        return t
+
+    def changed_since(self, version):
+        """版数 version の時点から今までの変更をまとめた (a, b, n) を返す。
+        「当時の [a, b) が今の [a, a + n) に置き換わり、その前後は当時と
+        同じ内容(後ろ側は n - (b - a) だけずれる)」という意味。
+        履歴を遡れない(別のバッファの版数、または古すぎる)なら None。"""
+        if version == self.version:
+            return 0, 0, 0
+        for i, (v, _, _, _) in enumerate(self._edits):
+            if v == version:
+                break
+        else:
+            return None
+        # 変更範囲を順に合成する: [oa, ob) は当時の座標、[na, nb) は今の座標
+        _, oa, ob, n = self._edits[i]
+        na, nb = oa, oa + n
+        for _, a, b, n in self._edits[i + 1:]:
+            if a < na:
+                oa, na = a, a
+            if b > nb:
+                ob += b - nb
+                nb = b
+            nb += n - (b - a)
+        return oa, ob, nb - na
+
+    def iter_chunks(self, start=0, stop=None, size=None):
+        """[start, stop) を最大 size バイトずつの bytes 断片として順に返す"""
+        size = size or self.CHUNK
+        stop = self._len if stop is None else min(stop, self._len)
+        if start >= stop:
+            return
+        k, i, o = self._locate(start)
+        pos = start
+        for buf, off, ln in self._walk(k, i):
+            while o < ln and pos < stop:
+                n = min(ln - o, stop - pos, size)
+                yield bytes(buf[off + o:off + o + n])
+                pos += n
+                o += n
+            if pos >= stop:
+                return
+            o = 0
+
+    def _spans(self, start, stop, reverse=False):
+        """[start, stop) と重なる各ピースについて
+        (buf, 論理位置→buf内位置の差分, 論理開始位置, 論理終了位置) を返す"""
+        if start >= stop:
+            return
+        pos = stop - 1 if reverse else start
+        k, i, o = self._locate(pos)
+        lo = pos - o
+        first = True
+        for buf, off, ln in self._walk(k, i, reverse):
+            if reverse and not first:
+                lo -= ln
+            first = False
+            yield buf, off - lo, max(lo, start), min(lo + ln, stop)
+            if reverse:
+                if lo <= start:
+                    return
+            else:
+                lo += ln
+                if lo >= stop:
+                    return
+
+    def _find_empty(self, start, end, reverse):
+        """空列の find/rfind (bytes と同じ位置の補正規則)"""
+        n = self._len
+        end = n if end is None else end
+        start = max(0, start + n) if start < 0 else start
+        end = min(n, max(0, end + n) if end < 0 else end)
+        if start > n or start > end:
+            return -1
+        return end if reverse else start
+
+    def find(self, sub, start=0, end=None):
+        """bytes.find と同じ。各ピースの元バッファ(bytes/mmap/add)上で
+        直接 find し、ピース境界をまたぐ一致だけを境界前後の小さな窓で探す
+        ため、バッファ全体をコピーしない。"""
+        sub = bytes(sub)
+        if not sub:
+            return self._find_empty(start, end, False)
+        start, end, _ = slice(start, end).indices(self._len)
+        m = len(sub)
+        for buf, delta, lo, hi in self._spans(start, end):
+            i = buf.find(sub, lo + delta, hi + delta)
+            if i >= 0:
+                return i - delta
+            # このピースの末尾をまたぐ一致 (開始位置 hi-m+1 .. hi-1)
+            wlo = max(start, hi - m + 1)
+            whi = min(end, hi + m - 1)
+            if hi < end and whi - wlo >= m:
+                i = self.read(wlo, whi).find(sub)
+                if i >= 0:
+                    return wlo + i
+        return -1
+
+    def rfind(self, sub, start=0, end=None):
+        """bytes.rfind と同じ。find と同様にピース単位で後ろから探す。"""
+        sub = bytes(sub)
+        if not sub:
+            return self._find_empty(start, end, True)
+        start, end, _ = slice(start, end).indices(self._len)
+        m = len(sub)
+        for buf, delta, lo, hi in self._spans(start, end, reverse=True):
+            i = buf.rfind(sub, lo + delta, hi + delta)
+            if i >= 0:
+                return i - delta
+            # このピースの先頭をまたぐ一致 (開始位置 lo-m+1 .. lo-1)
+            wlo = max(start, lo - m + 1)
+            whi = min(end, lo + m - 1)
+            if lo > start and whi - wlo >= m:
+                i = self.read(wlo, whi).rfind(sub)
+                if i >= 0:
+                    return wlo + i
+        return -1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._len)
+            if step != 1:
+                return bytes(self)[key]
+            return self.read(start, stop)
+        k, i, o = self._locate(self._index(key))
+        buf, off, _ = self._blocks[k][i]
+        return buf[off + o]
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def __bytes__(self):
+        return self.read(0, self._len)
+
+    def __eq__(self, other):
+        if isinstance(other, PieceTable):
+            other = bytes(other)
+        elif not isinstance(other, (bytes, bytearray, memoryview)):
+            return NotImplemented
+        other = memoryview(other).cast('B')
+        if len(other) != self._len:
+            return False
+        pos = 0
+        for chunk in self.iter_chunks():
+            if other[pos:pos + len(chunk)] != chunk:
+                return False
+            pos += len(chunk)
+        return True
+
+    __hash__ = None
+
+    def __repr__(self):
+        if self._len <= 256:
+            return f"PieceTable({bytes(self)!r})"
+        return f"PieceTable(<{self._len} bytes, {sum(map(len, self._blocks))} pieces>)"
+
+    # ------------------------------------------------------------------
+    # 変更 (bytearray 互換)
+    # ------------------------------------------------------------------
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._len)
+            if step != 1:
+                tmp = bytearray(self)
+                tmp[key] = value
+                self._splice(0, self._len, tmp)
+                return
+            if isinstance(value, int):
+                raise TypeError("can assign only bytes, buffers, or iterables of ints in range(0, 256)")
+            self._splice(start, max(start, stop), value)
+            return
+        idx = self._index(key)
+        v = operator.index(value)
+        if not 0 <= v <= 0xff:
+            raise ValueError('byte must be in range(0, 256)')
+        self._splice(idx, idx + 1, (v,))
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._len)
+            if step != 1:
+                tmp = bytearray(self)
+                del tmp[key]
+                self._splice(0, self._len, tmp)
+            elif start < stop:
+                self._splice(start, stop, b'')
+            return
+        idx = self._index(key)
+        self._splice(idx, idx + 1, b'')
+
+    def __iadd__(self, other):
+        self._splice(self._len, self._len, other)
+        return self
+
+    def extend(self, data):
+        self._splice(self._len, self._len, data)
+
+    def append(self, v):
+        self._splice(self._len, self._len, (v,))
+
+    def insert(self, index, v):
+        index = operator.index(index)
+        if index < 0:
+            index = max(0, index + self._len)
+        index = min(index, self._len)
+        self._splice(index, index, (v,))
+
+
 # ========================================================================
 # グローバル変数: @コマンド(exec)や{}式(eval)からアクセス可能
-#   mem  -- 編集中ファイルのバイト列 (bytearray)。MemoryBuffer.mem は
+#   mem  -- 編集中ファイルのバイト列 (PieceTable)。MemoryBuffer.mem は
 #           このグローバルを直接参照するプロパティで、二重管理はしない。
 #   cp   -- 現在のカーソル位置 (int, current position)。BiEditor.cp も同様。
 #   setmem(addr, data) -- memへの書き込みヘルパー
 #
-#   bytearray を使うのは、旧実装の「1バイトごとに Python の int オブジェクトを
-#   保持する list[int]」だと大きいファイル(バイナリエディタ本来の用途である
-#   ディスクイメージや実行ファイルなど)でメモリ使用量・編集速度が破綻するため。
+#   旧実装の「1バイトごとに Python の int オブジェクトを保持する list[int]」
+#   だと大きいファイル(ディスクイメージや実行ファイルなど)でメモリ使用量が、
+#   bytearray でも先頭付近への挿入・削除のたびに後続全体が移動して編集速度
+#   が破綻するため、ピーステーブルで保持する。
 # ========================================================================
-mem: bytearray = bytearray()
+mem: PieceTable = PieceTable()
 cp: int = 0
 
 def setmem(addr: int, data: int) -> None:
@@ -92,6 +533,40 @@ def setmem(addr: int, data: int) -> None:
     mem[addr] = int(data) & 0xff
 
 
+# ピーステーブルのまま渡せる mem の属性
+_PIECE_ATTRS = frozenset({'find', 'rfind', 'extend', 'append', 'insert', 'read', 'iter_chunks'})
+
+def _mem_needs_bytes(code, mode):
+    """@exec / {}eval のコード code が mem を bytes として扱うかどうか。
+
+    mem[i], mem[a:b] (読み書き・削除), len(mem), mem.find() 等、mem への
+    代入、mem += .. だけならピーステーブルのままで扱え、コストは触った
+    範囲だけで済む。それ以外 (mem + b"..", mem.replace(), re.sub(.., mem)
+    のように bytes / バッファプロトコルを前提にした使い方) は True。
+    構文エラーのコードは False (実行時にエラーになる)。"""
+    try:
+        tree = ast.parse(code, mode=mode)
+    except (SyntaxError, ValueError):
+        return False
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            if not (isinstance(child, ast.Name) and child.id == 'mem'):
+                continue
+            if isinstance(child.ctx, ast.Store):
+                continue
+            if isinstance(node, ast.Subscript) and node.value is child:
+                continue
+            if isinstance(node, ast.Attribute) and node.attr in _PIECE_ATTRS:
+                continue
+            if isinstance(node, ast.AugAssign) and node.target is child:
+                continue
+            if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                    and node.func.id == 'len' and child in node.args):
+                continue
+            return True
+    return False
+
+
 # ========================================================================
 # パーシャル編集の状態管理 (C版 g_partial 相当)
 # ========================================================================
@@ -106,6 +581,69 @@ class _PartialState:
 g_partial = _PartialState()
 
 
+# ========================================================================
+# バイト値 → 表示文字列の表 (256要素、起動時に一度だけ作る)
+#   HEX_PAIRS[b]     -- 16進欄のセル "XX"
+#   GLYPHS[b]        -- 文字欄の1文字 (0x20..0x7e はそのまま、他は '.')
+#   GLYPH_TABLE      -- GLYPHS と同じ対応の bytes.translate 用の表
+#   CTRL_NOTATION[b] -- printdata の文字表記 ("^@" / "'A'" / ".")
+#   repaint や hexdump で1バイトごとに書式化・分岐しないための表。
+# ========================================================================
+HEX_PAIRS = [f"{b:02X}" for b in range(256)]
+GLYPH_TABLE = bytes(b if 0x20 <= b <= 0x7e else 0x2e for b in range(256))
+GLYPHS = GLYPH_TABLE.decode('ascii')
+CTRL_NOTATION = ['^' + chr(b + ord('@')) if b < 0x20 else
+                 '.' if b > 0x7e else "'" + chr(b) + "'" for b in range(256)]
+# UTF-8 の先頭バイト(0xc0..0xf7)以外を消す translate 用の表
+_NON_UTF8_LEAD = bytes(b for b in range(256) if not 0xc0 <= b <= 0xf7)
+
+
+def format_row(data, width=16):
+    """1行分のバイト列を (16進欄, 文字欄) の文字列にする。
+    16進欄はセルを空白1つで区切り、width に満たない分は "~~" / "~" で埋める。"""
+    pad = width - len(data)
+    hexs = data.hex(' ').upper()
+    if pad > 0:
+        fill = ' '.join(['~~'] * pad)
+        hexs = hexs + ' ' + fill if hexs else fill
+    return hexs, data.translate(GLYPH_TABLE).decode('ascii') + '~' * max(pad, 0)
+
+
+def has_utf8_lead(data):
+    """バイト列に UTF-8 の多バイト文字の先頭バイトが含まれるか"""
+    return bool(data.translate(None, _NON_UTF8_LEAD))
+
+
+# 正しい UTF-8 の多バイト文字1つ (bytes.decode('utf-8') が通るものと同じ:
+# 冗長表現・サロゲート・U+10FFFF 超を除く)
+_UTF8_SEQ = re.compile(rb'[\xc2-\xdf][\x80-\xbf]'
+                       rb'|\xe0[\xa0-\xbf][\x80-\xbf]'
+                       rb'|[\xe1-\xec\xee\xef][\x80-\xbf]{2}'
+                       rb'|\xed[\x80-\x9f][\x80-\xbf]'
+                       rb'|\xf0[\x90-\xbf][\x80-\xbf]{2}'
+                       rb'|[\xf1-\xf3][\x80-\xbf]{3}'
+                       rb'|\xf4[\x80-\x8f][\x80-\xbf]{2}')
+
+
+def format_utf8_cells(buf, lo, hi, limit):
+    """buf[lo:hi] の文字欄を UTF-8 の多バイト文字を復号して作る。
+    多バイト文字は hi を越えて limit まで読み、2/3バイト文字の後に空白1つ、
+    4バイト文字の後に空白2つを足して桁を揃える(他のバイトは GLYPHS)。"""
+    out = []
+    p = lo
+    for m in _UTF8_SEQ.finditer(buf, lo, limit):
+        s = m.start()
+        if s >= hi:
+            break
+        out.append(buf[p:s].translate(GLYPH_TABLE).decode('ascii'))
+        ch = m.group()
+        out.append(ch.decode('utf-8') + ('  ' if len(ch) == 4 else ' '))
+        p = m.end()
+    if p < hi:
+        out.append(buf[p:hi].translate(GLYPH_TABLE).decode('ascii'))
+    return ''.join(out)
+
+
 class Terminal:
     """ターミナル制御を担当するクラス"""
     ESC = '\x1b['
@@ -119,109 +657,282 @@ class Terminal:
         # True のときスクリプト中でもカラー系エスケープのみ出力を許可する
         # （f コマンドを -c で色付き出力するために使用）。
         self.force_color = False
+        self._frame = None  # frame() の中で出力を溜めるリスト
+        # 画面が前のフレームから崩れた(消去・コマンド出力・シェル等)かどうか。
+        # Display が次の repaint で影画面を捨てるのに使う。
+        self._damaged = True
     
     def _scripting(self):
         return self.get_scripting is not None and self.get_scripting()
+
+    def write(self, s):
+        """端末へ出力する。frame() の中では出力をフレームに溜めるだけにする。"""
+        if self._frame is not None:
+            self._frame.append(s)
+        else:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+    @contextlib.contextmanager
+    def frame(self):
+        """中で行った出力を1フレームにまとめ、抜けるときに1回の write と
+        flush で端末へ送る(入れ子にした場合は一番外側で送る)。
+
+        画面の再描画はセルごとの色替え・カーソル移動・文字出力の積み重ね
+        なので、それぞれを直接書くと1画面で数千回の write になり、
+        遅い回線では描画が目に見えて遅くなる。"""
+        if self._frame is not None:
+            yield
+            return
+        self._frame = []
+        try:
+            yield
+        finally:
+            data = ''.join(self._frame)
+            self._frame = None
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+    def invalidate(self):
+        """画面の内容が分からなくなったことを記録する(次の repaint で全行を
+        送り直させる)。readline のプロンプトやシェルの子プロセスのように
+        sys.stdout を通らない出力もあるので、画面を崩しうる処理が明示的に呼ぶ。"""
+        self._damaged = True
+
+    def take_damage(self):
+        """invalidate() されていれば True を返し、記録を消す"""
+        damaged = self._damaged
+        self._damaged = False
+        return damaged
+
+    def frame_mark(self):
+        """今のフレームに溜まっている出力の位置 (frame_since/frame_drop 用)"""
+        return len(self._frame) if self._frame is not None else None
+
+    def frame_since(self, mark):
+        return ''.join(self._frame[mark:])
+
+    def frame_drop(self, mark):
+        del self._frame[mark:]
     
     def nocursor(self):
         if self._scripting(): return
-        print(f"{self.ESC}?25l", end='', flush=True)
+        self.write(f"{self.ESC}?25l")
     
     def dispcursor(self):
         if self._scripting(): return
-        print(f"{self.ESC}?25h", end='', flush=True)
+        self.write(f"{self.ESC}?25h")
     
     def up(self, n=1):
         if self._scripting(): return
-        print(f"{self.ESC}{n}A", end='')
+        self.write(f"{self.ESC}{n}A")
     
     def down(self, n=1):
         if self._scripting(): return
-        print(f"{self.ESC}{n}B", end='')
+        self.write(f"{self.ESC}{n}B")
     
     def right(self, n=1):
         if self._scripting(): return
-        print(f"{self.ESC}{n}C", end='')
+        self.write(f"{self.ESC}{n}C")
     
     def left(self, n=1):
         if self._scripting(): return
-        print(f"{self.ESC}{n}D", end='', flush=True)
+        self.write(f"{self.ESC}{n}D")
     
     def locate(self, x=0, y=0):
         if self._scripting(): return
-        print(f"{self.ESC}{y+1};{x+1}H", end='', flush=True)
+        self.write(f"{self.ESC}{y+1};{x+1}H")
     
     def scrollup(self, n=1):
         if self._scripting(): return
-        print(f"{self.ESC}{n}S", end='')
+        self.write(f"{self.ESC}{n}S")
     
     def scrolldown(self, n=1):
         if self._scripting(): return
-        print(f"{self.ESC}{n}T", end='')
+        self.write(f"{self.ESC}{n}T")
+
+    def scroll_region(self, top, bottom):
+        """スクロール範囲 (DECSTBM) を top..bottom 行 (0 始まり、両端含む) にする"""
+        if self._scripting(): return
+        self.write(f"{self.ESC}{top+1};{bottom+1}r")
+
+    def reset_scroll_region(self):
+        if self._scripting(): return
+        self.write(f"{self.ESC}r")
     
     def clear(self):
         if self._scripting(): return
         if self.termcol == 'color':
             # coltab フルカラーモード
-            print("\033[40m", end='')
+            self.write("\033[40m")
         elif self.termcol == 'black':
             # 黒地に白: fg=白(37), bg=黒(40) 固定
-            print("\033[40m", end='')
+            self.write("\033[40m")
         elif self.termcol == 'white':
             # 白地に黒: fg=黒(30), bg=白(47) 固定
-            print(f"\033[47m", end='')
+            self.write(f"\033[47m")
 
-        print(f"{self.ESC}2J", end='', flush=True)
+        self.write(f"{self.ESC}2J")
         self.locate()
+        self.invalidate()
     
     def clraftcur(self):
         if self._scripting(): return
-        print(f"{self.ESC}0J", end='', flush=True)
+        self.write(f"{self.ESC}0J")
     
     def clrline(self):
         if self._scripting(): return
-        print(f"{self.ESC}2K", end='', flush=True)
+        self.write(f"{self.ESC}2K")
     
     def rev(self):
         if self._scripting() and not self.force_color: return
-        print(f"{self.ESC}7m",end='',flush=True)
+        self.write(f"{self.ESC}7m")
 
     def revreset(self):
         if self._scripting() and not self.force_color: return
-        print(f"{self.ESC}27m",end='',flush=True)
+        self.write(f"{self.ESC}27m")
 
 
     def color(self, col1=7, col2=0):
         if self._scripting() and not self.force_color: return
         if self.termcol == 'color':
             # coltab フルカラーモード（UI要素ごとに色が変わる・従来の挙動）
-            print(f"{self.ESC}{self.coltab[col1]};{self.bcoltab[col2]}m", end='', flush=True)
+            self.write(f"{self.ESC}{self.coltab[col1]};{self.bcoltab[col2]}m")
         elif self.termcol == 'black':
             # 黒地に白: fg=白(37), bg=黒(40) 固定
-            print(f"{self.ESC}37m{self.ESC}40m", end='', flush=True)
+            self.write(f"{self.ESC}37m{self.ESC}40m")
         elif self.termcol == 'white':
             # 白地に黒: fg=黒(30), bg=白(47) 固定
-            print(f"{self.ESC}30m{self.ESC}47m", end='', flush=True)
+            self.write(f"{self.ESC}30m{self.ESC}47m")
         # else: 指定なし → カラーエスケープを出力しない（端末本来の色を維持）
     
     def resetcolor(self):
         if self._scripting() and not self.force_color: return
-        print(f"{self.ESC}0m", end='')
+        self.write(f"{self.ESC}0m")
 
     def highlight_color(self):
         """検索ヒット箇所のハイライト色 (緑地に明るいシアン・太字)"""
         if self._scripting() and not self.force_color: return
-        print(f"\x1b[1;96;44m", end='', flush=True)
+        self.write(f"\x1b[1;96;44m")
     
+    # raw_mode() 中の入力状態 (端末はプロセスに1つなのでクラスで共有する)
+    _saved_mode = None  # raw_mode() に入る前の端末設定 (raw_mode() 外では None)
+    _raw_attrs = None   # キー待ち用: ISIG なし (Ctrl-C 等もキーとして読む)
+    _sig_attrs = None   # コマンド実行用: ISIG あり (Ctrl-C で中断できる)
+    _interruptible = 0  # interruptible() の入れ子の深さ
+    _pending = ''       # 読み込み済みでまだ getch() が返していない文字
+    _decoder = None
+
     @staticmethod
-    def getch():
+    def _raw_attrs_of(fd, saved):
+        """入力だけを raw にした端末設定を返す。出力の改行変換 (OPOST) は
+        残すので、raw のまま print しても従来どおり行頭へ戻る。"""
+        tty.setraw(fd, termios.TCSANOW)
+        mode = termios.tcgetattr(fd)
+        mode[1] = saved[1]
+        return mode
+
+    @classmethod
+    def _current_attrs(cls):
+        return cls._sig_attrs if cls._interruptible else cls._raw_attrs
+
+    @classmethod
+    @contextlib.contextmanager
+    def raw_mode(cls):
+        """編集セッションの間、端末を raw のままにする(抜けるときに戻す)。
+
+        キー待ち用 (ISIG なし) とコマンド実行用 (ISIG あり、interruptible()
+        参照) の2つの設定をここで一度だけ作るので、getch() は端末設定に
+        触れずに os.read するだけで済む。入力はまとめて読むので、キー
+        リピートや貼り付けで一度に届いた分はシステムコールなしで1文字ずつ
+        返せる。"""
+        fd = sys.stdin.fileno()
+        if cls._saved_mode is not None or not os.isatty(fd):
+            yield
+            return
+        saved = termios.tcgetattr(fd)
+        cls._raw_attrs = cls._raw_attrs_of(fd, saved)
+        cls._sig_attrs = list(cls._raw_attrs)
+        cls._sig_attrs[3] |= termios.ISIG
+        termios.tcsetattr(fd, termios.TCSANOW, cls._raw_attrs)
+        cls._saved_mode = saved
+        cls._decoder = codecs.getincrementaldecoder(
+            sys.stdin.encoding or 'utf-8')(errors='replace')
+        try:
+            yield
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, cls._saved_mode)
+            cls._saved_mode = None
+
+    @classmethod
+    @contextlib.contextmanager
+    def interruptible(cls):
+        """raw_mode() 中、コマンドを実行する間だけ ISIG を有効にして
+        Ctrl-C で中断 (KeyboardInterrupt) できるようにする"""
+        if cls._saved_mode is None:
+            yield
+            return
+        fd = sys.stdin.fileno()
+        cls._interruptible += 1
+        if cls._interruptible == 1:
+            termios.tcsetattr(fd, termios.TCSANOW, cls._sig_attrs)
+        try:
+            yield
+        finally:
+            cls._interruptible -= 1
+            if cls._interruptible == 0:
+                termios.tcsetattr(fd, termios.TCSANOW, cls._raw_attrs)
+
+    @classmethod
+    @contextlib.contextmanager
+    def cooked_mode(cls):
+        """raw_mode() 中に readline やシェルへ端末を渡す間だけ元の設定に戻す"""
+        if cls._saved_mode is None:
+            yield
+            return
         fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
+        termios.tcsetattr(fd, termios.TCSADRAIN, cls._saved_mode)
         try:
-            tty.setraw(fd)
-            return sys.stdin.read(1)
+            yield
         finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+            termios.tcsetattr(fd, termios.TCSANOW, cls._current_attrs())
+
+    @classmethod
+    def input_pending(cls):
+        """raw_mode() 中に、待たずに読めるキー入力が残っていれば True"""
+        if cls._saved_mode is None:
+            return False
+        if cls._pending:
+            return True
+        return bool(select.select([sys.stdin.fileno()], [], [], 0)[0])
+
+    @classmethod
+    def getch(cls):
+        if cls._saved_mode is None:
+            fd = sys.stdin.fileno()
+            old_settings = termios.tcgetattr(fd)
+            try:
+                tty.setraw(fd)
+                return sys.stdin.read(1)
+            finally:
+                termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+        fd = sys.stdin.fileno()
+        while not cls._pending:
+            if cls._interruptible:
+                # コマンド実行中の「[ Hit a key ]」等: 待つ間は Ctrl-C もキー
+                termios.tcsetattr(fd, termios.TCSANOW, cls._raw_attrs)
+                try:
+                    data = os.read(fd, 4096)
+                finally:
+                    termios.tcsetattr(fd, termios.TCSANOW, cls._sig_attrs)
+            else:
+                data = os.read(fd, 4096)
+            if not data:
+                return ''   # EOF
+            cls._pending = cls._decoder.decode(data)
+        ch = cls._pending[0]
+        cls._pending = cls._pending[1:]
+        return ch
 
 
 class HistoryManager:
@@ -245,7 +956,8 @@ class HistoryManager:
         mode = "search" if mode == "search" else "command"
         self.set_history_list(mode)
         try:
-            user_input = input(s)
+            with Terminal.cooked_mode():
+                user_input = input(s)
         except (EOFError, KeyboardInterrupt):
             # Ctrl+D/Ctrl+C でのコマンドライン入力中断はキャンセル扱いにする
             user_input = ""
@@ -257,7 +969,7 @@ class HistoryManager:
 class MemoryBuffer:
     """メモリバッファ管理クラス。
 
-    バッファ実体はモジュールグローバルの mem (bytearray) そのもの。
+    バッファ実体はモジュールグローバルの mem (PieceTable) そのもの。
     self.mem はそのグローバルを直接読み書きするプロパティであり、
     インスタンスごとにコピーを持たない（@exec / {}eval からの mem[] 参照
     と同一の実体を指すことを保証し、手動同期を不要にするため）。
@@ -265,12 +977,15 @@ class MemoryBuffer:
     UNKNOWN = 0xffffffffffffffffffffffffffffffff
 
     def __init__(self):
-        self.mem = bytearray()
+        self.mem = PieceTable()
         self.yank = []
         self.mark = [self.UNKNOWN] * 26
         self.modified = False
         self.lastchange = False
         self._diff_log = None   # None=非記録中, list=記録中
+        # 差分ログのデータ部(挿入・削除・上書きの内容)は不変の bytes で持つ。
+        # list[int] だと1バイトあたり8バイトのポインタ(+int オブジェクト)に
+        # なり、大きな削除や貼り付けの undo がバッファの何倍ものメモリを食う。
         # save_undo_state()/commit_undo() の呼び出し漏れ検出用フック。
         # BiEditor が設定する（scripting中は undo を意図的に無効化しているため
         # 呼ばれない）。将来コマンドを追加する際に undo 記録を忘れると、
@@ -284,7 +999,14 @@ class MemoryBuffer:
     @mem.setter
     def mem(self, value):
         global mem
-        mem = value if isinstance(value, bytearray) else bytearray(value)
+        mem = value if isinstance(value, PieceTable) else PieceTable(value)
+
+    @property
+    def version(self):
+        """バッファの編集版数。内容が変わるたびに単調に増える
+        (@exec からの直接変更やバッファの差し替えも含む)ので、
+        検索結果などのキャッシュの有効性判定に使える。"""
+        return self.mem.version
 
     def set_untracked_mutation_hook(self, fn):
         self._untracked_mutation_hook = fn
@@ -304,7 +1026,40 @@ class MemoryBuffer:
         """差分記録を終了し、記録済み差分リストを返す"""
         log = self._diff_log
         self._diff_log = None
-        return log if log else []
+        if not log:
+            return []
+        # 記録中に伸ばしていた上書き区間(bytearray)を不変の bytes に確定する
+        for i, entry in enumerate(log):
+            if entry[0] == 'ovw_region' and isinstance(entry[2], bytearray):
+                log[i] = ('ovw_region', entry[1], bytes(entry[2]), bytes(entry[3]), entry[4])
+        return log
+
+    def _log_overwrite(self, start, old, new, orig_len):
+        """上書き [start, start+len(new)) を差分ログに記録する。
+        直前のエントリが接する・重なる上書き区間なら、新しいエントリを足さずに
+        その区間を広げる(旧データは先に記録した方、新データは後の書き込みを
+        残す)。1バイトずつの書き込みが続いても undo/redo は区間1件の
+        スライスコピーで済む。orig_len は最初の書き込み前のバッファ長のまま。"""
+        log = self._diff_log
+        end = start + len(new)
+        if log and log[-1][0] == 'ovw_region' and isinstance(log[-1][2], bytearray):
+            _, s, old_r, new_r, first_len = log[-1]
+            e = s + len(new_r)
+            if s <= start <= e:
+                # 区間の中か末尾に続く書き込み: その場で伸ばす
+                if end > e:
+                    old_r += old[e - start:]
+                new_r[start - s:end - s] = new
+                return
+            if start < s <= end:
+                # 区間の前に接する・重なる書き込み: つなぎ直す
+                lo, hi = start, max(end, e)
+                old_u = bytearray(old) + old_r[end - s:] if end < e else bytearray(old)
+                old_u[s - lo:s - lo + len(old_r)] = old_r
+                new_u = bytearray(new) + new_r[end - s:] if end < e else bytearray(new)
+                log[-1] = ('ovw_region', lo, old_u[:hi - lo], new_u[:hi - lo], first_len)
+                return
+        log.append(('ovw_region', start, bytearray(old), bytearray(new), orig_len))
 
     def cancel_diff(self):
         """差分記録を破棄して終了する"""
@@ -326,8 +1081,7 @@ class MemoryBuffer:
         old_val = self.mem[addr]
         new_val = int(data) & 0xff
         if self._diff_log is not None:
-            # ('ovw', addr, old_byte, new_byte, orig_mem_len)
-            self._diff_log.append(('ovw', addr, old_val, new_val, orig_len))
+            self._log_overwrite(addr, bytes((old_val,)), bytes((new_val,)), orig_len)
         self.mem[addr] = new_val
         self.modified = True
         self.lastchange = True
@@ -344,14 +1098,14 @@ class MemoryBuffer:
             old_len = len(self.mem)
             inserted = bytearray(start - old_len) + mem2
             if self._diff_log is not None:
-                self._diff_log.append(('ins', old_len, list(inserted)))
+                self._diff_log.append(('ins', old_len, bytes(inserted)))
             self.mem += inserted
             self.modified = True
             self.lastchange = True
             return
 
         if self._diff_log is not None:
-            self._diff_log.append(('ins', start, list(mem2)))
+            self._diff_log.append(('ins', start, bytes(mem2)))
         self.mem[start:start] = mem2
         self.modified = True
         self.lastchange = True
@@ -363,7 +1117,7 @@ class MemoryBuffer:
         self._check_untracked()
 
         if self._diff_log is not None:
-            self._diff_log.append(('del', start, list(self.mem[start:end+1])))
+            self._diff_log.append(('del', start, self.mem[start:end+1]))
 
         if yf:
             yankmem_func(start, end)
@@ -386,7 +1140,7 @@ class MemoryBuffer:
         # "0,99999999999 y" で8秒以上応答なし)。ループの範囲自体を
         # バッファ末尾でクランプする(bi.c の memory_yank は元々この形)。
         end = min(end, len(self.mem) - 1)
-        self.yank = [self.mem[j] & 0xff for j in range(start, end + 1)]
+        self.yank = list(self.mem[start:end + 1])
         return len(self.yank)
 
     def ovwmem(self, start, mem0):
@@ -394,15 +1148,17 @@ class MemoryBuffer:
             return
         self._check_untracked()
 
-        mem0 = bytearray(b & 0xff for b in mem0)
+        if isinstance(mem0, (bytes, bytearray)):
+            mem0 = bytes(mem0)
+        else:
+            mem0 = bytearray(b & 0xff for b in mem0)
 
         if self._diff_log is not None:
             orig_len = len(self.mem)
             # 変更前の該当領域を保存（拡張予定分は 0 で補完）
-            old_region = list(self.mem[start:start+len(mem0)])
-            while len(old_region) < len(mem0):
-                old_region.append(0)
-            self._diff_log.append(('ovw_region', start, old_region, list(mem0), orig_len))
+            old_region = self.mem[start:start+len(mem0)]
+            old_region += bytes(len(mem0) - len(old_region))
+            self._log_overwrite(start, old_region, mem0, orig_len)
 
         # start が末尾より先にある(ギャップができる)場合も含め、必要な長さまで
         # まとめて0埋めしてから一括で置き換える。
@@ -414,17 +1170,44 @@ class MemoryBuffer:
         self.lastchange = True
         self.modified = True
 
+    def submem(self, hits, repl):
+        """置換: hits=[(pos, length), ...] (昇順・重なりなし) の各領域を
+        repl に置き換える。
+
+        置換後の領域を断片のリストとして組み立てて1回で差し替えるため、
+        ヒットごとに delmem + insmem する場合と違いヒット数に対して線形。
+        差分ログには ('sub', [(pos, 旧データ), ...], repl) を1件だけ記録する
+        (pos は置換前の位置)。
+        """
+        if not hits:
+            return
+        self._check_untracked()
+        repl = bytes(repl)
+        start = hits[0][0]
+        stop = hits[-1][0] + hits[-1][1]
+        old = self.mem[start:stop]
+        parts = []
+        olds = []
+        prev = start
+        for pos, length in hits:
+            parts.append(old[prev - start:pos - start])
+            parts.append(repl)
+            olds.append((pos, old[pos - start:pos - start + length]))
+            prev = pos + length
+        if self._diff_log is not None:
+            self._diff_log.append(('sub', olds, repl))
+        self.mem[start:stop] = b''.join(parts)
+        self.modified = True
+        self.lastchange = True
+
     def redmem(self, start, end):
-        m = []
-        for i in range(start, end + 1):
-            if len(self.mem) > i:
-                m.append(self.mem[i] & 0xff)
-            else:
-                m.append(0)
+        m = list(self.mem[start:end + 1])
+        if len(m) < end - start + 1:
+            m += [0] * (end - start + 1 - len(m))
         return m
 
     def regulate_mem(self):
-        """bytearray は要素が常に 0-255 の int であることを型として保証する
+        """PieceTable は要素が常に 0-255 の int であることを型として保証する
         ため、現在は前方互換のための no-op(大きいバッファでの無駄な
         O(n) ループを避ける)。"""
         pass
@@ -433,6 +1216,9 @@ class MemoryBuffer:
 class SearchEngine:
     """検索エンジンクラス"""
 
+    RE_WINDOW = 1 << 12  # 後方正規表現検索の最初の窓幅 (以後倍々に広げる)
+    MAX_TABLES = 4       # 一致表キャッシュに残すパターン数の上限
+
     def __init__(self, memory_buffer, display, get_flags=None):
         self.memory = memory_buffer
         self.display = display
@@ -442,8 +1228,11 @@ class SearchEngine:
         self.remem = ''
         self.span = 0
         self.nff = True
-        self._regex_matches = None  # begin_scan() までは None (未走査)
-        self._regex_error = False
+        # False: 正規表現を bytes パターンとしてバッファのバイト列に直接適用する。
+        # True : バッファを UTF-8 (不正なら latin-1) の文字列として扱う(_utf8 で切替)。
+        self.utf8 = False
+        # 一致表のキャッシュ: (種別, パターン, モード, 編集版数) -> 表
+        self._tables = {}
 
     def stdmm(self, s):
         if self.get_flags is not None:
@@ -462,38 +1251,391 @@ class SearchEngine:
         self.display.clrmm()
     
     def hit(self, addr):
-        for i in range(len(self.smem)):
-            if addr + i < len(self.memory.mem) and self.memory.mem[addr + i] == self.smem[i]:
-                continue
+        sub = bytes(self.smem)
+        return 1 if self.memory.mem[addr:addr + len(sub)] == sub else 0
+
+    def _find_hex(self, lo, hi):
+        """16進検索: 開始位置が [lo, hi) にある最初の一致位置 (無ければ -1)"""
+        sub = bytes(self.smem)
+        return self.memory.mem.find(sub, lo, hi + len(sub) - 1)
+
+    def _rfind_hex(self, lo, hi):
+        """16進検索: 開始位置が [lo, hi) にある最後の一致位置 (無ければ -1)"""
+        sub = bytes(self.smem)
+        return self.memory.mem.rfind(sub, lo, hi + len(sub) - 1)
+
+    def _find_re(self, target, lo, hi):
+        """正規表現検索: 開始位置が [lo, hi) にある最初のマッチ位置 (無ければ -1)。
+        マッチの届く範囲 reach が分かるときはバッファを連結せず、lo から
+        窓を倍々に広げながら読んで探すので、手間は次のマッチまでの距離に
+        比例しファイルサイズによらない。窓の終端 whi に対して s + fwd <= whi
+        の開始位置 s は窓だけで正しく判定できるので、それより先にしか
+        無ければ whi - fwd から次の窓で探し直す。"""
+        pattern, reach, buf = target
+        if reach is None:
+            m = pattern.search(buf, lo)
+            if m is None or m.start() >= hi:
+                return -1
+            self.span = m.end() - m.start()
+            return m.start()
+        fwd, back = reach
+        mem = self.memory.mem
+        cap = min(len(mem), hi + fwd)
+        size = max(self.RE_WINDOW, 4 * fwd)
+        pos = lo
+        while pos < hi:
+            wlo = max(0, pos - back)
+            whi = min(cap, pos + size)
+            win = mem.read(wlo, whi)
+            m = pattern.search(win, pos - wlo)
+            if m is not None and (whi >= cap or wlo + m.start() + fwd <= whi):
+                if wlo + m.start() >= hi:
+                    return -1
+                self.span = m.end() - m.start()
+                return wlo + m.start()
+            if whi >= cap:
+                return -1
+            pos = max(pos, whi - fwd)
+            size *= 2
+        return -1
+
+    def _rfind_re(self, target, lo, hi):
+        """正規表現検索: 開始位置が [lo, hi) にある最後のマッチ位置 (無ければ -1)。
+        正規表現は後ろ向きに走らせられないので、hi の手前から窓を倍々に
+        広げながら、窓の先頭から前方検索で窓内の最後の開始位置を求める。
+        reach が分かるときは窓の前後 back, fwd バイトだけ読み足せば足りる。
+        分からないときは連続ビューを探すが、窓内に無いときの前方検索は
+        窓の後ろの次のマッチ (無ければ末尾) まで走ってしまうので、次の窓は
+        その行き過ぎ分以上に広げて手間を抑える。"""
+        pattern, reach, buf = target
+        mem_len = len(self.memory.mem)
+        end = hi
+        size = self.RE_WINDOW
+        if reach is not None:
+            fwd, back = reach
+            size = max(size, 4 * fwd)
+        while end > lo:
+            p = max(lo, end - size)
+            w = p
+            last = -1
+            over = 0
+            if reach is None:
+                view, base = buf, 0
             else:
-                return 0
-        return 1
-    
-    def begin_scan(self):
-        """新しい検索操作の開始時に呼ぶ: hitre() の全マッチキャッシュを破棄する。
-
-        旧実装は hitre(addr) 呼び出しのたびにアドレスから固定128バイトだけを
-        切り出して re.match を試みていたため、128バイトを超える位置に
-        マッチの後半がある正規表現（例: 'A+END' で A が129個以上続く場合）
-        を検出できなかった。バッファ全体を対象に re.finditer を一度だけ
-        走査してマッチ開始位置を全て求めておき、hitre() はその結果を
-        参照するだけにすることで、長さの制限なく正しくマッチできるように
-        している（走査自体も1バイトずつ Python で re.match するより高速）。
+                base = max(0, p - back)
+                view = self.memory.mem.read(base, min(mem_len, end + fwd))
+            while p < end:
+                m = pattern.search(view, p - base)
+                if m is None or base + m.start() >= end:
+                    over = (base + m.start() if m else mem_len) - end
+                    break
+                last = base + m.start()
+                self.span = m.end() - m.start()
+                p = last + 1
+            if last >= 0:
+                return last
+            end = w
+            size = max(size * 2, over)
+        return -1
+
+    @staticmethod
+    def _find_sorted(starts, lo, hi):
+        """一致表の昇順開始位置 starts から [lo, hi) にある最初の位置 (無ければ -1)"""
+        i = bisect.bisect_left(starts, lo)
+        return starts[i] if i < len(starts) and starts[i] < hi else -1
+
+    @staticmethod
+    def _rfind_sorted(starts, lo, hi):
+        """一致表の昇順開始位置 starts から [lo, hi) にある最後の位置 (無ければ -1)"""
+        i = bisect.bisect_left(starts, hi)
+        return starts[i - 1] if i > 0 and starts[i - 1] >= lo else -1
+
+    def _regex_target(self):
+        """バイト列モードの検索対象 (コンパイル済みパターン, reach, 連続ビュー)。
+        reach が分かるときは窓ごとに読むので連続ビューは作らず None。
+        不正な正規表現なら None。"""
+        try:
+            pattern = self.compile_regex(self.remem)
+        except re.error:
+            return None
+        reach = self._reach()
+        if reach is not None:
+            return pattern, reach, None
+        return pattern, None, self.memory.mem.contiguous()
+
+    def _finders(self):
+        """n/N 用の (find, rfind) を返す。不正な正規表現なら None。
+
+        一致表はハイライト用で、左から重ならないマッチしか持たないため
+        n/N には使わず、バッファをカーソル位置から直接探す (16進検索は
+        重なった一致にも止まる)。表があるかどうかで止まる位置が変わらない。
+        UTF-8 モードは文字位置とバイト位置の対応が要るので表を引く。"""
+        if self.regexp and self.utf8:
+            table = self._match_table()
+            if table is None:
+                return None
+            starts = table[0]
+            return (lambda lo, hi: self._find_sorted(starts, lo, hi),
+                    lambda lo, hi: self._rfind_sorted(starts, lo, hi))
+        if not self.regexp:
+            return self._find_hex, self._rfind_hex
+        target = self._regex_target()
+        if target is None:
+            return None
+        return (lambda lo, hi: self._find_re(target, lo, hi),
+                lambda lo, hi: self._rfind_re(target, lo, hi))
+
+    def _searchnext_in(self, find, fp, mem_len):
+        """searchnext の本体: find(lo, hi) で fp 以降を探し、無ければ先頭から
+        fp 手前までをもう一度だけ探す(ラップアラウンド)"""
+        self.stdmm_wait("Wait.")
+        pos = find(fp, mem_len)
+        if pos >= 0:
+            self.clrmm()
+            return pos
+        if not self.nff or fp <= 0:
+            # 先頭から探していたなら折り返す範囲はない
+            self.clrmm()
+            return None
+        self.stdmm_wait("Search reached BOTTOM, wrap around to TOP.")
+        pos = find(0, min(fp, mem_len))
+        if pos >= 0:
+            return pos
+        self.clrmm()
+        return None
+
+    def _searchlast_in(self, rfind, fp, mem_len):
+        """searchlast の本体: rfind(lo, hi) で fp 以前を後ろから探し、無ければ
+        末尾から fp の直後までをもう一度だけ探す(ラップアラウンド)"""
+        self.stdmm_wait("Wait.")
+        pos = rfind(0, min(fp + 1, mem_len))
+        if pos >= 0:
+            self.clrmm()
+            return pos
+        if fp + 1 >= mem_len:
+            # 末尾から探していた (カーソルが先頭にあった場合を含む) なら
+            # 折り返す範囲はない
+            self.clrmm()
+            return None
+        self.stdmm_wait("Search reached TOP, wrap around to BOTTOM.")
+        pos = rfind(fp + 1, mem_len)
+        if pos >= 0:
+            return pos
+        self.clrmm()
+        return None
+
+    def compile_regex(self, s):
+        """現在のモードで正規表現 s をコンパイルする(不正なら re.error)。
+        バイト列モードではパターンを UTF-8 でエンコードした bytes 正規表現
+        にするので、マッチ位置がそのままバイト位置になる。"""
+        if self.utf8:
+            return re.compile(s)
+        try:
+            return re.compile(s.encode('utf-8'))
+        except UnicodeEncodeError as e:
+            raise re.error(str(e))
+
+    def _table_key(self):
+        if self.regexp:
+            return ('re', self.remem, self.utf8, self.memory.version)
+        return ('hex', bytes(self.smem), None, self.memory.version)
+
+    def _match_table(self, limit=None):
+        """現在のパターンの一致表 (starts, spans, complete) を返す。
+        不正な正規表現なら None。
+
+        表は (種別, パターン, モード, 編集版数) ごとにキャッシュするので、
+        バッファが変わるまではハイライトや置換のたびに走査し直さない。
+        starts は昇順の開始位置、spans は対応するマッチ長で、マッチは
+        左から重ならないように取る (正規表現は re.finditer の順)。
+        16進検索は limit 件で打ち切ることがあり、その場合 complete は False。
         """
-        self._regex_matches = None
-        self._regex_error = False
+        key = self._table_key()
+        table = self._cached_table(key)
+        if table is not None and (table[2] or (limit is not None
+                                               and len(table[0]) >= limit)):
+            return table
+        table = self._scan_regex() if self.regexp else self._scan_hex(limit)
+        if table is None:
+            return None
+        self._store_table(key, table)
+        return table
+
+    def _store_table(self, key, table):
+        # 同じパターンの古い版数の表は置き換え、残りも件数を抑える
+        for k in [k for k in self._tables if k[:3] == key[:3]]:
+            del self._tables[k]
+        while len(self._tables) >= self.MAX_TABLES:
+            del self._tables[next(iter(self._tables))]
+        self._tables[key] = table
+
+    def _cached_table(self, key):
+        """key の一致表をキャッシュから返す。無くても同じパターンの古い版数の
+        完全な表があれば、その後の変更範囲の周辺だけ走査し直して作る。"""
+        table = self._tables.get(key)
+        if table is not None:
+            return table
+        for k, old in self._tables.items():
+            if k[:3] == key[:3] and old[2]:
+                break
+        else:
+            return None
+        change = self.memory.mem.changed_since(k[3])
+        reach = self._reach()
+        if change is None or reach is None:
+            return None
+        table = self._repair_table(old, change, reach)
+        self._store_table(key, table)
+        return table
+
+    def _reach(self):
+        """マッチ判定が開始位置 s の前後どこまでのバイトを見るか (前方, 後方)。
+        前方は [s, s + 前方) を、後方は [s - 後方, s) を見る。
+        上限の無い正規表現、先読み・後読み・後方参照を含む正規表現、
+        UTF-8 モードは None (一致表を部分的に直せない)。"""
+        if not self.regexp:
+            return len(self.smem), 0
+        if self.utf8:
+            return None
+        try:
+            pattern = self.compile_regex(self.remem)
+        except re.error:
+            return None
+        tree = sre_parse.parse(pattern.pattern, pattern.flags)
 
-    def _ensure_regex_scan(self):
-        if self._regex_matches is not None or self._regex_error:
-            return
-        self._regex_matches = {}
+        def plain(p):
+            for op, av in p:
+                if str(op) in ('ASSERT', 'ASSERT_NOT',
+                               'GROUPREF', 'GROUPREF_EXISTS'):
+                    return False
+                for x in av if isinstance(av, (tuple, list)) else (av,):
+                    if isinstance(x, sre_parse.SubPattern) and not plain(x):
+                        return False
+                    if isinstance(x, list) and not all(
+                            plain(y) for y in x
+                            if isinstance(y, sre_parse.SubPattern)):
+                        return False
+            return True
+
+        width = tree.getwidth()[1]
+        if width >= sre_parse.MAXREPEAT or not plain(tree):
+            return None
+        # ^ $ \b などは前後1バイト、$ は末尾の改行の先の終端まで見る
+        return width + 2, 1
+
+    def _repair_table(self, table, change, reach):
+        """変更前の一致表 table を、変更 (a, b, n) の周辺だけ走査し直して
+        今のバッファ用に直す。
+
+        開始位置 s のマッチ判定は [s - back, s + fwd) しか見ないので、
+        s + fwd <= a のマッチはそのまま残せる。その直後から左から順に
+        走査し直し、変更範囲より back 以上後ろで変更前と同じマッチ
+        (位置は n - (b - a) ずれる) に出会えば、以降は変更前と同じ列に
+        なるので位置をずらして繋ぐ。"""
+        starts, spans, _ = table
+        a, b, n = change
+        fwd, back = reach
+        delta = n - (b - a)
+        i = bisect.bisect_right(starts, a - fwd)
+        new_starts = starts[:i]
+        new_spans = spans[:i]
+        restart = max(0, a - fwd)
+        if i:
+            restart = max(restart, starts[i - 1] + spans[i - 1])
+        for pos, span in self._iter_matches(restart, reach):
+            if new_starts and new_starts[-1] == pos:
+                continue
+            if pos >= a + n + back:
+                j = bisect.bisect_left(starts, pos - delta)
+                if (j < len(starts) and starts[j] == pos - delta
+                        and spans[j] == span):
+                    new_starts.extend(x + delta for x in starts[j:])
+                    new_spans.extend(spans[j:])
+                    break
+            new_starts.append(pos)
+            new_spans.append(span)
+        return new_starts, new_spans, True
+
+    def _iter_matches(self, pos, reach):
+        """pos から左から重ならないように (開始位置, 長さ) を順に返す。
+
+        正規表現はバッファ全体を連結せず、窓を倍々に広げながら読んで
+        走査する。窓の終端 hi に対して s + fwd <= hi のマッチ判定は窓だけで
+        正しいので、それを越えたら hi - fwd (より前のマッチの終端が後ろなら
+        そこ) から次の窓で探し直す。"""
+        mem = self.memory.mem
+        mem_len = len(mem)
+        if not self.regexp:
+            span = len(self.smem)
+            while True:
+                pos = self._find_hex(pos, mem_len)
+                if pos < 0:
+                    return
+                yield pos, span
+                pos += span
+        pattern = self.compile_regex(self.remem)
+        fwd, back = reach
+        size = max(self.RE_WINDOW, 4 * fwd)
+        while True:
+            lo = max(0, pos - back)
+            hi = min(mem_len, pos + size)
+            win = mem.read(lo, hi)
+            resume = max(pos, hi - fwd)
+            for m in pattern.finditer(win, pos - lo):
+                start = lo + m.start()
+                if hi < mem_len and start + fwd > hi:
+                    break
+                yield start, m.end() - m.start()
+                resume = max(resume, lo + m.end())
+            if hi >= mem_len:
+                return
+            pos = resume
+            size *= 2
+
+    def _scan_hex(self, limit):
+        span = len(self.smem)
+        mem_len = len(self.memory.mem)
+        starts = []
+        pos = 0
+        complete = False
+        while limit is None or len(starts) < limit:
+            pos = self._find_hex(pos, mem_len)
+            if pos < 0:
+                complete = True
+                break
+            starts.append(pos)
+            pos += span
+        return starts, [span] * len(starts), complete
+
+    def _scan_regex(self):
+        """バッファ全体を re.finditer で一度だけ走査して一致表を作る
+        (マッチの長さに制限はない)。同じ開始位置のマッチは最初のものだけ残す。"""
+        starts = []
+        spans = []
         if not self.remem:
-            return
+            return starts, spans, True
         try:
-            pattern = re.compile(self.remem)
+            pattern = self.compile_regex(self.remem)
         except re.error:
-            self._regex_error = True
-            return
+            return None
+
+        def add(start, end):
+            if not starts or starts[-1] != start:
+                starts.append(start)
+                spans.append(end - start)
+
+        if not self.utf8:
+            # バイト列モード: バッファを str へデコードしない。マッチの届く
+            # 範囲が分かれば窓ごとに読んで走査し、分からないときだけ
+            # 連続ビューに直接 finditer する。
+            reach = self._reach()
+            if reach is not None:
+                for start, span in self._iter_matches(0, reach):
+                    add(start, start + span)
+                return starts, spans, True
+            for m in pattern.finditer(self.memory.mem.contiguous()):
+                add(m.start(), m.end())
+            return starts, spans, True
 
         raw = bytes(self.memory.mem)
         try:
@@ -506,7 +1648,7 @@ class SearchEngine:
         if encoding == 'latin-1':
             # latin-1 は1バイト=1文字なので文字位置がそのままバイト位置になる
             for m in pattern.finditer(text):
-                self._regex_matches.setdefault(m.start(), m.end() - m.start())
+                add(m.start(), m.end())
         else:
             # utf-8 は文字位置とバイト位置がずれるため対応表を作る
             char_to_byte = []
@@ -516,99 +1658,60 @@ class SearchEngine:
                 b += len(ch.encode('utf-8'))
             char_to_byte.append(b)  # 番兵(文字列末尾のバイト位置)
             for m in pattern.finditer(text):
-                start_b = char_to_byte[m.start()]
-                end_b = char_to_byte[m.end()]
-                self._regex_matches.setdefault(start_b, end_b - start_b)
-
-    def hitre(self, addr):
-        if not self.remem:
-            return -1
-
-        self.span = 0
-        self._ensure_regex_scan()
-        if self._regex_error:
-            return -1
+                add(char_to_byte[m.start()], char_to_byte[m.end()])
+        return starts, spans, True
 
-        span = self._regex_matches.get(addr)
-        if span is None:
-            return 0
-        self.span = span
-        return 1
-    
     def searchnext(self, fp, mem_len):
         if mem_len == 0:
             self.clrmm()
             return None
-        self.begin_scan()
-        curpos = fp
-        start = fp
-        wrapped = False
         if not self.regexp and not self.smem:
             return False
-        self.stdmm_wait("Wait.")
-        while True:
-            f = self.hitre(curpos) if self.regexp else self.hit(curpos)
-            
-            if f == 1:
-                if not wrapped:
-                    self.clrmm()
-                return curpos
-            elif f < 0:
-                if not wrapped:
-                    self.clrmm()
-                return None
-            
-            curpos += 1
-            
-            if curpos >= mem_len:
-                if self.nff:
-                    if not wrapped:
-                        self.stdmm_wait("Search reached BOTTOM, wrap around to TOP.")
-                        wrapped = True
-                    curpos = 0
-                else:
-                    self.clrmm()
-                    return None
-            
-            if curpos == start:
-                self.clrmm()
-                return None
+        finders = self._finders()
+        if finders is None:
+            self.clrmm()
+            return None
+        return self._searchnext_in(finders[0], fp, mem_len)
     
     def searchlast(self, fp, mem_len):
         if mem_len == 0:
             self.clrmm()
             return None
-        self.begin_scan()
-        wrapped = False
         if fp < 0:
             fp = mem_len - 1
-        curpos = fp
-        start = fp
         if not self.regexp and not self.smem:
             return False
-        if not wrapped:
-            self.stdmm_wait("Wait.")
-        while True:
-            f = self.hitre(curpos) if self.regexp else self.hit(curpos)
-            
-            if f == 1:
-                if not wrapped:
-                    self.clrmm()
-                return curpos
-            elif f < 0:
-                if not wrapped:
-                    self.clrmm()
-                return None
-            
-            curpos -= 1
-            if curpos < 0:
-                self.stdmm_wait("Search reached TOP, wrap around to BOTTOM.")
-                wrapped = True
-                curpos = mem_len - 1
-            
-            if curpos == start:
-                self.clrmm()
+        finders = self._finders()
+        if finders is None:
+            self.clrmm()
+            return None
+        return self._searchlast_in(finders[1], fp, mem_len)
+
+    def collect_matches(self, start, end):
+        """開始位置が [start, end] に入るマッチを、バッファを1回走査して
+        左から重ならないように [(pos, length), ...] で返す。
+        幅 0 の正規表現マッチに達したらそこで打ち切る(置換が前進しないため)。
+        正規表現が不正なら None を返す。"""
+        hits = []
+        if self.regexp:
+            table = self._match_table()
+            if table is None:
                 return None
+            starts, spans, _ = table
+            i = bisect.bisect_left(starts, start)
+            for pos, span in zip(starts[i:], spans[i:]):
+                if pos > end or span == 0:
+                    break
+                hits.append((pos, span))
+            return hits
+        span = len(self.smem)
+        if not span:
+            return hits
+        pos = self._find_hex(start, end + 1)
+        while pos >= 0:
+            hits.append((pos, span))
+            pos = self._find_hex(pos + span, end + 1)
+        return hits
 
     def search_all(self, mem_len, max_results=10000):
         """全てのマッチ箇所を検索して返す"""
@@ -617,25 +1720,14 @@ class SearchEngine:
             return matches
         if not self.regexp and not self.smem:
             return matches
-        self.begin_scan()
 
         self.stdmm_wait("Searching all matches...")
-        curpos = 0
-        
-        while curpos < mem_len and len(matches) < max_results:
-            f = self.hitre(curpos) if self.regexp else self.hit(curpos)
-            
-            if f == 1:
-                # マッチした位置と長さを保存
-                match_len = self.span if self.regexp else len(self.smem)
-                matches.append((curpos, match_len))
-                # 次の検索位置は現在のマッチの後から
-                curpos += max(1, match_len)
-            elif f < 0:
-                break
-            else:
-                curpos += 1
-        
+        table = self._match_table(max_results)
+        if table is not None:
+            starts, spans, _ = table
+            # 末尾位置の幅 0 マッチはバッファ外なので含めない
+            n = min(bisect.bisect_left(starts, mem_len), max_results)
+            matches = list(zip(starts[:n], spans[:n]))
         self.clrmm()
         return matches
 
@@ -657,6 +1749,11 @@ class Display:
         self.insmod = False
         # 複数のハイライト範囲をリストで管理 [(pos, len), ...]
         self.highlight_ranges = []
+        # 影画面: 前回 repaint で端末へ送った各行の出力 {行キー: 文字列}
+        self._shadow = {}
+        self._shadow_size = None
+        self._shadow_home = None    # 影画面を描いたときの homeaddr
+        self._mm_dirty = True       # メッセージ行に何か出ているかもしれない
         # 画面サイズに応じた行数を初期化
         self.update_screen_size()
 
@@ -664,8 +1761,10 @@ class Display:
         """端末サイズを取得して BOTTOMLN / LENONSCR を再計算する。
         取得できない場合はデフォルト値 (BOTTOMLN=22) を使用する。"""
         try:
-            rows = os.get_terminal_size().lines
+            self.term_size = os.get_terminal_size()
+            rows = self.term_size.lines
         except OSError:
+            self.term_size = None
             rows = 24          # フォールバック
         # パーシャルモード中かつ25行以上のときだけPARTIAL行を独立させる
         # それ以外はフッター2行のみ使い、BOTTOMLN+1が画面最下部になる
@@ -705,92 +1804,205 @@ class Display:
             else:
                 self.scrdown()
     
+    @property
+    def highlight_ranges(self):
+        return self._hl_ranges
+
+    @highlight_ranges.setter
+    def highlight_ranges(self, ranges):
+        # 開始位置順に並べ、終端の累積最大値も持っておくと、ある区間に
+        # 重なる範囲を二分探索で絞り込める(範囲どうしが重なっていてもよい)
+        self._hl_ranges = sorted(ranges)
+        self._hl_starts = [pos for pos, _ in self._hl_ranges]
+        self._hl_maxends = list(itertools.accumulate(
+            (pos + length for pos, length in self._hl_ranges), max))
+        self._hl_window = (0, b'')  # repaint 中の表示範囲のハイライト表
+
+    def _overlapping_ranges(self, lo, hi):
+        """[lo, hi) に重なるハイライト範囲を返す"""
+        i = bisect.bisect_right(self._hl_maxends, lo)
+        j = bisect.bisect_left(self._hl_starts, hi)
+        return [(pos, length) for pos, length in self._hl_ranges[i:j]
+                if pos + length > lo]
+
+    def _prepare_highlight(self, lo, hi):
+        """repaint の最初に一度だけ、[lo, hi) の各バイトがハイライト範囲に
+        入るかの表を作る。以後の is_highlighted() は表引きだけで済む。"""
+        mask = bytearray(hi - lo)
+        for pos, length in self._overlapping_ranges(lo, hi):
+            a = max(pos, lo) - lo
+            b = min(pos + length, hi) - lo
+            mask[a:b] = b'\x01' * (b - a)
+        self._hl_window = (lo, mask)
+
     def is_highlighted(self, addr):
         """指定アドレスがハイライト範囲に含まれるか判定"""
-        for pos, length in self.highlight_ranges:
-            if pos <= addr < pos + length:
-                return True
-        return False
+        lo, mask = self._hl_window
+        if lo <= addr < lo + len(mask):
+            return mask[addr - lo] == 1
+        return bool(self._overlapping_ranges(addr, addr + 1))
     
+    def _row_highlighted(self, addr, n):
+        """[addr, addr+n) のどこかがハイライト範囲に入るか (_prepare_highlight 後)"""
+        lo, mask = self._hl_window
+        if lo <= addr and addr + n <= lo + len(mask):
+            return any(mask[addr - lo:addr - lo + n])
+        return bool(self._overlapping_ranges(addr, addr + n))
+
     def printchar(self, a):
         if a >= len(self.memory.mem):
-            print("~", end='', flush=True)
+            self.term.write("~")
             return 1
         
+        b = self.memory.mem[a]
         if self.utf8:
-            if self.memory.mem[a] < 0x80 or 0x80 <= self.memory.mem[a] <= 0xbf or 0xf8 <= self.memory.mem[a] <= 0xff:
-                print(chr(self.memory.mem[a] & 0xff) if 0x20 <= self.memory.mem[a] <= 0x7e else '.', end='')
+            if b < 0xc0 or b >= 0xf8:
+                self.term.write(GLYPHS[b])
                 return 1
-            elif 0xc0 <= self.memory.mem[a] <= 0xdf:
+            elif 0xc0 <= b <= 0xdf:
                 m = [self.memory.readmem(a), self.memory.readmem(a + 1)]
                 try:
                     ch = bytes(m).decode('utf-8')
                     # 2バイト=2桁ぶんに揃えるため末尾空白1つ(3/4バイト分岐と同様の整列)
-                    print(f"{ch} ", end='', flush=True)
+                    self.term.write(f"{ch} ")
                     return 2
                 except UnicodeDecodeError:
-                    print(".", end='')
+                    self.term.write(".")
                     return 1
-            elif 0xe0 <= self.memory.mem[a] <= 0xef:
+            elif 0xe0 <= b <= 0xef:
                 m = [self.memory.readmem(a), self.memory.readmem(a + 1), self.memory.readmem(a + 2)]
                 try:
                     ch = bytes(m).decode('utf-8')
-                    print(f"{ch} ", end='', flush=True)
+                    self.term.write(f"{ch} ")
                     return 3
                 except UnicodeDecodeError:
-                    print(".", end='')
+                    self.term.write(".")
                     return 1
-            elif 0xf0 <= self.memory.mem[a] <= 0xf7:
+            elif 0xf0 <= b <= 0xf7:
                 m = [self.memory.readmem(a), self.memory.readmem(a + 1), 
                      self.memory.readmem(a + 2), self.memory.readmem(a + 3 )]
                 try:
                     ch = bytes(m).decode('utf-8')
-                    print(f"{ch}  ", end='', flush=True)
+                    self.term.write(f"{ch}  ")
                     return 4
                 except UnicodeDecodeError:
-                    print(".", end='')
+                    self.term.write(".")
                     return 1
         else:
-            print(chr(self.memory.mem[a] & 0xff) if 0x20 <= self.memory.mem[a] <= 0x7e else '.', end='')
+            self.term.write(GLYPHS[b])
             return 1
     
     def print_title(self, filename):
         self.term.locate(0, 0)
         self.term.color(6)
-        print(f'bi Py version 3.5.2 by Taisuke Maekawa          utf8mode:{"off" if not self.utf8 else "on "}     {"insert   " if self.insmod else "overwrite"}   ')
+        self.term.write(f'bi Py version 3.5.2 by Taisuke Maekawa          utf8mode:{"off" if not self.utf8 else "on "}     {"insert   " if self.insmod else "overwrite"}   \n')
         self.term.color(5)
         if len(filename) > 35:
             fn = filename[0:35]
         else:
             fn = filename
-        print(f'file:[{fn:<35}] length:{len(self.memory.mem)} bytes [{("not " if not self.memory.modified else "")+"modified"}]    ')
+        self.term.write(f'file:[{fn:<35}] length:{len(self.memory.mem)} bytes [{("not " if not self.memory.modified else "")+"modified"}]    \n')
     
     def repaint(self, filename):
+        """画面全体を描き直す(1フレームとして一度に出力する)"""
+        with self.term.frame():
+            self._repaint(filename)
+
+    def invalidate(self):
+        """影画面を捨てる(次の repaint で全行を送り直す)。
+        メッセージ行も何が出ているか分からなくなったものとする。"""
+        self._shadow = {}
+        self._mm_dirty = True
+
+    def _damage(self, key, mark, body=None):
+        """mark 以後にフレームへ書いた分を行 key の出力として影画面と比べ、
+        前回と同じならフレームから取り除く(変わった行だけを端末へ送る)。
+        body を渡すと比べるのは body 以後だけにする(行頭のカーソル移動を
+        除いておけば、スクロールで別の行へ動いた内容とも比べられる)。"""
+        if mark is None:
+            return
+        s = self.term.frame_since(mark if body is None else body)
+        if self._shadow.get(key) == s:
+            self.term.frame_drop(mark)
+        else:
+            self._shadow[key] = s
+
+    def _scroll_shadow(self):
+        """前回の表示から homeaddr が画面の高さ未満の行数だけ動いていれば、
+        データ行だけをスクロール範囲にして端末自身にスクロールさせ、
+        影画面の行もそのぶんずらす(新しく現れた行だけが描き直しになる)。"""
+        rows = self.LENONSCR // 16
+        if self._shadow_home is None or not self._shadow:
+            return
+        d = self.homeaddr - self._shadow_home
+        if d == 0 or d % 16 or abs(d) // 16 >= rows:
+            return
+        n = d // 16
+        self.term.scroll_region(3, 3 + rows - 1)
+        if n > 0:
+            self.term.scrollup(n)
+        else:
+            self.term.scrolldown(-n)
+        self.term.reset_scroll_region()
+        shifted = {y: self._shadow[y + n] for y in range(rows)
+                   if 0 <= y + n < rows and y + n in self._shadow}
+        for y in range(rows):
+            self._shadow.pop(y, None)
+        self._shadow.update(shifted)
+
+    def _repaint(self, filename):
         self.update_screen_size()   # リサイズに追従
+        # 端末サイズが変わったか、前回のフレームの後に画面へ何か書かれたら
+        # 影画面は当てにならないので全行を送り直す
+        size = (self.term_size, self.BOTTOMLN, self.LENONSCR)
+        if self.term.take_damage() or size != self._shadow_size:
+            self.invalidate()
+            self._shadow_size = size
+        self._scroll_shadow()
+        self._shadow_home = self.homeaddr
+        mark = self.term.frame_mark()
         self.print_title(filename)
+        self._damage('title', mark)
         self.term.nocursor()
+        mark = self.term.frame_mark()
         self.term.locate(0, 2)
         self.term.color(4)
-        print("OFFSET       +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F 0123456789ABCDEF ")
+        self.term.write("OFFSET       +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F 0123456789ABCDEF \n")
         self.term.color(7)
+        self._damage('header', mark)
         addr = self.homeaddr
+        # 文字欄は UTF-8 の多バイト文字で表示範囲の末尾を最大3バイト越える
+        self._prepare_highlight(addr, addr + self.LENONSCR + 3)
         for y in range(self.LENONSCR // 16):
+            mark = self.term.frame_mark()
             self.term.color(5)
             self.term.locate(0, 3 + y)
-            print(f"{(addr + y * 16 + g_partial.offset) & 0xffffffffffff:012X} ", end='')
+            body = self.term.frame_mark()
+            self.term.write(f"{(addr + y * 16 + g_partial.offset) & 0xffffffffffff:012X} ")
             self.term.color(7)
+            row = y * 16 + addr
+            data = self.memory.mem[row:row + 16]
+            if not (self.highlight_ranges and self._row_highlighted(row, 16)) \
+                    and not (self.utf8 and has_utf8_lead(data)):
+                # ハイライトも多バイト文字もない行は表でまとめて書式化する
+                hexs, ascs = format_row(data)
+                self.term.write(hexs + " ")
+                self.term.color(6)
+                self.term.write(ascs + "  ")
+                self._damage(y, mark, body)
+                continue
             for i in range(16):
                 a = y * 16 + i + addr
                 in_hl = (self.highlight_ranges and self.is_highlighted(a))
                 if in_hl:
                     self.term.highlight_color()
-                    print(f"~~" if a >= len(self.memory.mem) else f"{self.memory.mem[a] & 0xff:02X}", end='')
+                    self.term.write("~~" if i >= len(data) else HEX_PAIRS[data[i]])
                     self.term.resetcolor()
                     self.term.color(7)
-                    print(" ", end='')
+                    self.term.write(" ")
                 else:
                     self.term.color(7)
-                    print(f"~~ " if a >= len(self.memory.mem) else f"{self.memory.mem[a] & 0xff:02X} ", end='')
+                    self.term.write("~~ " if i >= len(data) else HEX_PAIRS[data[i]] + " ")
             self.term.color(7)
             self.term.color(6)
             a = y * 16 + addr
@@ -807,7 +2019,8 @@ class Display:
                     c = self.printchar(a)
                 a += c
                 by += c
-            print("  ", end='', flush=True)
+            self.term.write("  ")
+            self._damage(y, mark, body)
         self.term.color(0)
         self.term.dispcursor()
     
@@ -820,17 +2033,11 @@ class Display:
         self.term.clrline()          # \n なしで行をクリア（末尾改行によるスクロール防止）
         self.term.locate(0, self.BOTTOMLN+1)
         self.term.color(6)
-        s = '.'
-        if a < 0x20:
-            s = '^' + chr(a + ord('@'))
-        elif a > 0x7e:
-            s = '.'
-        else:
-            s = "'" + chr(a) + "'"
+        s = CTRL_NOTATION[a & 0xff]
         if addr < len(self.memory.mem):
-            print(f"{file_addr:012X} : 0x{a:02X} 0b{a:08b} 0o{a:03o} {a} {s}      ", end='', flush=True)
+            self.term.write(f"{file_addr:012X} : 0x{a:02X} 0b{a:08b} 0o{a:03o} {a} {s}      ")
         else:
-            print(f"{file_addr:012X} : ~~                                                   ", end='', flush=True)
+            self.term.write(f"{file_addr:012X} : ~~                                                   ")
 
         # PARTIAL ステータス: 25行以上のとき BOTTOMLN+2 に独立表示、それ以外は BOTTOMLN+1 に上書き
         partial_row = self.BOTTOMLN + 2 if self.has_partial_row else self.BOTTOMLN + 1
@@ -840,10 +2047,9 @@ class Display:
             # g_partial.length は元の読込長(writefile_partial のtail算出に使う)なので変更せず、
             # 表示は編集後の現在のバッファ長を見せる。
             cur_len = len(self.memory.mem)
-            print(
+            self.term.write(
                 f" PARTIAL  file_offset:0x{g_partial.offset:012X}"
-                f"  length:0x{cur_len:X}({cur_len}) bytes   ",
-                end='', flush=True
+                f"  length:0x{cur_len:X}({cur_len}) bytes   "
             )
         elif self.has_partial_row:
             self.term.clrline()
@@ -851,21 +2057,29 @@ class Display:
     def disp_curpos(self):
         self.term.color(4)
         self.term.locate(self.curx // 2 * 3 + 12, self.cury + 3)
-        print("[", end='', flush=True)
+        self.term.write("[")
         self.term.locate(self.curx // 2 * 3 + 15, self.cury + 3)
-        print("]", end='', flush=True)
+        self.term.write("]")
     
     def erase_curpos(self):
         self.term.color(7)
         self.term.locate(self.curx // 2 * 3 + 12, self.cury + 3)
-        print(" ", end='', flush=True)
+        self.term.write(" ")
         self.term.locate(self.curx // 2 * 3 + 15, self.cury + 3)
-        print(" ", end='', flush=True)
+        self.term.write(" ")
     
     def clrmm(self):
         self.term.locate(0, self.BOTTOMLN)
         self.term.color(6)
         self.term.clrline()
+        self._mm_dirty = False
+
+    def clear_message(self):
+        """メッセージ行に何か出ているときだけ消す (キー入力ごとに呼ぶ)。
+        キーリピートや貼り付けで描画を省いている間に、空のメッセージ行を
+        キーの数だけ消し直して端末へ書かないようにする。"""
+        if self._mm_dirty:
+            self.clrmm()
     
     def stdmm(self, s, scripting, verbose):
         if scripting:
@@ -875,7 +2089,8 @@ class Display:
             self.clrmm()
             self.term.color(4)
             self.term.locate(0, self.BOTTOMLN)
-            print(" " + s, end='', flush=True)
+            self.term.write(" " + s)
+            self._mm_dirty = True
     
     def stderr(self, s, scripting, verbose):
         if scripting:
@@ -884,7 +2099,8 @@ class Display:
             self.clrmm()
             self.term.color(3)
             self.term.locate(0, self.BOTTOMLN)
-            print(" " + s, end='', flush=True)
+            self.term.write(" " + s)
+            self._mm_dirty = True
 
 
 class Parser:
@@ -948,6 +2164,10 @@ class Parser:
                 # __builtins__ だけ封じて open()/__import__() 等の任意コード実行を防ぐ。
                 safe_globals = dict(globals())
                 safe_globals["__builtins__"] = {}
+                # bytes 系の書き方をする式には mem を bytes として渡す
+                # (mem[i] / len(mem) 程度ならピーステーブルのまま読む)
+                if _mem_needs_bytes(u, 'eval'):
+                    safe_globals["mem"] = self.memory.mem.tobytes()
                 v = int(eval(u, safe_globals, {}))
             except Exception:
                 return self.UNKNOWN, idx
@@ -1080,10 +2300,101 @@ class Parser:
 
 class FileManager:
     """ファイル入出力管理クラス"""
+    # mmap_mode == 'auto' のとき、このサイズ以上のファイルは mmap で開く
+    MMAP_THRESHOLD = 64 * 1024 * 1024
+
     def __init__(self, memory_buffer):
         self.memory = memory_buffer
         self.filename = ""
         self.newfile = False
+        self.mmap_mode = 'auto'   # 'auto' / 'on' / 'off'
+        self._mapped = None       # mmap 中の元ファイルの (st_dev, st_ino)
+
+    def _load(self, f):
+        """開いたファイル f の内容をバッファに載せる。
+        mmap_mode に応じて読み取り専用 mmap を元データとするピーステーブル
+        を作り、起動時間と常駐メモリを閲覧・編集した範囲だけに抑える。
+        mmap できないファイル(パイプ・特殊ファイル等)は通常の読み込みへ
+        フォールバックする。"""
+        self._mapped = None
+        st = os.fstat(f.fileno())
+        if self.mmap_mode == 'on' or (self.mmap_mode == 'auto' and st.st_size >= self.MMAP_THRESHOLD):
+            if st.st_size > 0:
+                try:
+                    self.memory.mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._mapped = (st.st_dev, st.st_ino)
+                    return
+                except (OSError, ValueError):
+                    pass
+        self.memory.mem = f.read()
+
+    def _maps(self, fn):
+        """fn が現在 mmap している元ファイルそのものかどうか"""
+        if self._mapped is None:
+            return False
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino) == self._mapped
+
+    def _write_chunks(self, fn, chunks):
+        """chunks を順に fn へ書き出す。
+
+        fn が mmap 中の元ファイルだと、その場で切り詰めた時点でまだ読んで
+        いないページが失われる(アクセスすると SIGBUS)。その場合は実体
+        (シンボリックリンクの先) と同じディレクトリの一時ファイルへ書き、
+        所有者とモードを合わせてから os.replace で差し替える (マッピングは
+        旧 inode を指したまま有効に残る)。ハードリンクがある、または所有者を
+        合わせられないときは、差し替えるとリンクが切れたり所有者が変わったり
+        するので、元データを一時ファイルへ退避してバッファをそちらへ付け
+        替えてから、元ファイルへその場で書く。
+        """
+        if not self._maps(fn):
+            with open(fn, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            return
+        real = os.path.realpath(fn)
+        st = os.stat(real)
+        fd, tmp = tempfile.mkstemp(prefix='.bi-', dir=os.path.dirname(real))
+        try:
+            with os.fdopen(fd, "w+b") as f:
+                if st.st_nlink == 1 and self._take_over(tmp, st):
+                    for chunk in chunks:
+                        f.write(chunk)
+                    f.close()
+                    os.replace(tmp, real)
+                    return
+                orig = self.memory.mem._orig
+                f.write(orig)
+                f.flush()
+                self.memory.mem.rebase(orig, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            os.unlink(tmp)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        # バッファはもう fn を参照しないので、普通に書き込める
+        self._mapped = None
+        with open(real, "r+b") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.truncate()
+
+    @staticmethod
+    def _take_over(path, st):
+        """path の所有者とモードを st に合わせる。所有者を合わせられなければ False"""
+        try:
+            os.chown(path, st.st_uid, st.st_gid)
+        except PermissionError:
+            tst = os.stat(path)
+            if (tst.st_uid, tst.st_gid) != (st.st_uid, st.st_gid):
+                return False
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        return True
     
     def readfile(self, fn):
         try:
@@ -1091,6 +2402,7 @@ class FileManager:
         except FileNotFoundError:
             # 存在しないファイルのみ「新規ファイル」として空バッファで開く。
             self.newfile = True
+            self._mapped = None
             self.memory.mem = []
             return True, "<new file>"
         except IsADirectoryError:
@@ -1106,7 +2418,7 @@ class FileManager:
             self.newfile = False
             try:
                 with f:
-                    self.memory.mem = bytearray(f.read())
+                    self._load(f)
                 return True, None
             except MemoryError:
                 return False, "Memory overflow."
@@ -1117,8 +2429,7 @@ class FileManager:
     def writefile(self, fn):
         self.memory.regulate_mem()
         try:
-            with open(fn, "wb") as f:
-                f.write(bytes(self.memory.mem))
+            self._write_chunks(fn, self.memory.mem.iter_chunks())
             return True, "File written."
         # 破綻点修正: readfile/readfile_partial/writefile_partial は
         # IsADirectoryError/PermissionError を明示的に小文字メッセージで
@@ -1141,12 +2452,10 @@ class FileManager:
     def wrtfile(self, start, end, fn):
         self.memory.regulate_mem()
         try:
-            with open(fn, "wb") as f:
-                for i in range(start, end + 1):
-                    if i < len(self.memory.mem):
-                        f.write(bytes([self.memory.mem[i]]))
-                    else:
-                        f.write(bytes([0]))
+            pad = max(0, end + 1 - max(start, len(self.memory.mem)))
+            chunks = itertools.chain(self.memory.mem.iter_chunks(start, end + 1),
+                                     [bytes(pad)] if pad else [])
+            self._write_chunks(fn, chunks)
             return True, None
         # 破綻点修正: writefile()と同根。range-write("start,end w fn")用の
         # このメソッドも同じ理由で明示分岐が欠けていたため追加。
@@ -1164,6 +2473,7 @@ class FileManager:
         except FileNotFoundError:
             # 存在しないファイルのみ新規パーシャルファイルとして開く。
             self.newfile = True
+            self._mapped = None
             self.memory.mem = []
             g_partial.active = True
             g_partial.offset = offset
@@ -1190,7 +2500,8 @@ class FileManager:
             except OSError:
                 return False, f"Partial read error: I/O error reading '{fn}'."
         actually_read = len(data)
-        self.memory.mem = bytearray(data)
+        self._mapped = None
+        self.memory.mem = data
         g_partial.active = True
         g_partial.offset = offset
         g_partial.length = actually_read
@@ -1277,8 +2588,252 @@ class FileManager:
         return True, f"Partial write: offset=0x{g_partial.offset:X}, {written} bytes written."
 
 
+# ========================================================================
+# undo 差分の直列化と退避ジャーナル
+#   diff リスト(MemoryBuffer の差分ログ)をバイト列にして一時ファイルへ
+#   追記し、必要になったら読み戻す。pickle は使わず、各エントリを
+#   「種別1バイト + 固定長の整数 + 長さ前置きのデータ」で表す。
+# ========================================================================
+_DIFF_OPS = {'ovw': 1, 'ovw_region': 2, 'ins': 3, 'del': 4, 'sub': 5}
+_DIFF_NAMES = {v: k for k, v in _DIFF_OPS.items()}
+
+
+def encode_diff(diff):
+    """差分リストをバイト列にする (decode_diff で元に戻る)"""
+    out = []
+    blob = lambda b: (struct.pack('<Q', len(b)), bytes(b))
+    for entry in diff:
+        op = entry[0]
+        out.append(struct.pack('<B', _DIFF_OPS[op]))
+        if op == 'ovw':
+            _, addr, old, new, orig_len = entry
+            out.append(struct.pack('<QBBQ', addr, old, new, orig_len))
+        elif op == 'ovw_region':
+            _, start, old, new, orig_len = entry
+            out.append(struct.pack('<QQ', start, orig_len))
+            out.extend(blob(old))
+            out.extend(blob(new))
+        elif op in ('ins', 'del'):
+            _, start, data = entry
+            out.append(struct.pack('<Q', start))
+            out.extend(blob(data))
+        else:
+            _, olds, repl = entry
+            out.append(struct.pack('<Q', len(olds)))
+            for pos, data in olds:
+                out.append(struct.pack('<Q', pos))
+                out.extend(blob(data))
+            out.extend(blob(repl))
+    return b''.join(out)
+
+
+def decode_diff(data):
+    """encode_diff のバイト列を差分リストに戻す。壊れていれば ValueError。"""
+    view = memoryview(data)
+    i = 0
+
+    def take(fmt):
+        nonlocal i
+        v = struct.unpack_from(fmt, view, i)
+        i += struct.calcsize(fmt)
+        return v
+
+    def blob():
+        nonlocal i
+        (n,) = take('<Q')
+        if i + n > len(view):
+            raise ValueError("truncated undo record")
+        b = bytes(view[i:i + n])
+        i += n
+        return b
+
+    diff = []
+    try:
+        while i < len(view):
+            (code,) = take('<B')
+            op = _DIFF_NAMES[code]
+            if op == 'ovw':
+                diff.append((op,) + take('<QBBQ'))
+            elif op == 'ovw_region':
+                start, orig_len = take('<QQ')
+                old = blob()
+                diff.append((op, start, old, blob(), orig_len))
+            elif op in ('ins', 'del'):
+                (start,) = take('<Q')
+                diff.append((op, start, blob()))
+            else:
+                (count,) = take('<Q')
+                olds = []
+                for _ in range(count):
+                    (pos,) = take('<Q')
+                    olds.append((pos, blob()))
+                diff.append((op, olds, blob()))
+    except (struct.error, KeyError) as e:
+        raise ValueError(f"broken undo record: {e}") from None
+    return diff
+
+
+def diff_size(diff):
+    """差分リストが保持するデータのおおよそのバイト数"""
+    n = 0
+    for entry in diff:
+        n += 64     # タプルと整数のぶん
+        if entry[0] == 'ovw_region':
+            n += len(entry[2]) + len(entry[3])
+        elif entry[0] in ('ins', 'del'):
+            n += len(entry[2])
+        elif entry[0] == 'sub':
+            n += len(entry[2]) + sum(len(d) + 64 for _, d in entry[1])
+    return n
+
+
+class UndoJournal:
+    """undo/redo の差分を退避する追記専用の一時ファイル。
+    最初の退避で作り、閉じると消える。append() が返す (offset, length) で
+    read() から読み戻す。"""
+
+    def __init__(self):
+        self._file = None
+        self.size = 0
+
+    def append(self, data):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='bi-undo-')
+        self._file.seek(self.size)
+        self._file.write(data)
+        self._file.flush()
+        ref = (self.size, len(data))
+        self.size += len(data)
+        return ref
+
+    def read(self, ref):
+        off, n = ref
+        self._file.seek(off)
+        data = self._file.read(n)
+        if len(data) != n:
+            raise OSError("undo journal is truncated")
+        return data
+
+    def clear(self):
+        """中身を捨てる(退避中の差分が一つも残っていないときに呼ぶ)"""
+        if self._file is not None:
+            self._file.truncate(0)
+        self.size = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.size = 0
+
+
+class UndoHistoryFile(UndoJournal):
+    """編集中のファイルの隣に置く永続 undo ジャーナル (--undo-journal)。
+
+    マジックの後に「種別1バイト + 長さ8バイト + 本体」のレコードを追記する
+    だけの形式で、次のレコードを持つ:
+
+      S  確定した状態 (STATE_META + encode_diff の差分)
+      U  undo した / R  redo した
+      B  開いた時点の / W  書き込んだ時点の ファイルのキー (KEY + 間引いた内容の sha256)
+      D  予算超過で退避した差分 (再生時は読み飛ばす)
+      Q  正常終了
+
+    レコードを先頭から再生すると undo/redo スタックの形が復元でき、B/W で
+    ディスク上の内容と対応する位置が、Q の有無で異常終了かどうかが分かる。
+    書き込みに一度失敗したら以後は何も書かない(壊れた列を残さない)。"""
+    MAGIC = b'BIUNDO1\n'
+    HEADER = struct.Struct('<BQ')
+    # cursor_before, cursor_after, modified_before, lastchange_before,
+    # mark_before[26], mark_after[26]  (未設定マークは NO_MARK)
+    STATE_META = struct.Struct('<QQBB26Q26Q')
+    NO_MARK = 0xffffffffffffffff
+    # ファイルのキー: サイズ, 更新時刻(ns)。内容は KEY_SAMPLES 個の
+    # KEY_BLOCK バイトを等間隔に取ってハッシュする(全体は読まない)。
+    KEY = struct.Struct('<QQ')
+    KEY_BLOCK = 4096
+    KEY_SAMPLES = 16
+
+    def __init__(self, path, create=False):
+        super().__init__()
+        self.path = path
+        self.failed = False
+        if create:
+            self._file = open(path, 'w+b')
+            self._file.write(self.MAGIC)
+            self._file.flush()
+            self.size = len(self.MAGIC)
+        else:
+            self._file = open(path, 'r+b')
+            if self._file.read(len(self.MAGIC)) != self.MAGIC:
+                self._file.close()
+                raise ValueError(f"'{path}' is not a bi undo journal")
+            self.size = self._file.seek(0, os.SEEK_END)
+
+    def records(self):
+        """(種別, 本体の位置, 本体の長さ) を順に返す。途中で切れた末尾の
+        レコードは捨て、以後の追記がその位置から始まるようにする。"""
+        pos = len(self.MAGIC)
+        while pos + self.HEADER.size <= self.size:
+            self._file.seek(pos)
+            kind, n = self.HEADER.unpack(self._file.read(self.HEADER.size))
+            body = pos + self.HEADER.size
+            if body + n > self.size:
+                break
+            yield bytes([kind]), body, n
+            pos = body + n
+        self.size = pos
+
+    def record(self, kind, *parts):
+        """レコードを追記して本体の位置を返す"""
+        if self.failed or self._file is None:
+            raise OSError("undo journal is not writable")
+        n = sum(len(p) for p in parts)
+        try:
+            self._file.seek(self.size)
+            self._file.write(self.HEADER.pack(kind[0], n))
+            for p in parts:
+                self._file.write(p)
+            self._file.flush()
+        except OSError:
+            self.failed = True
+            raise
+        body = self.size + self.HEADER.size
+        self.size = body + n
+        return body
+
+    def append(self, data):
+        return self.record(b'D', data), len(data)
+
+    def clear(self):
+        """永続ジャーナルは前のセッションの履歴も持つので消さない"""
+
+    @classmethod
+    def pack_state(cls, state):
+        mark = lambda m: [v if 0 <= v < cls.NO_MARK else cls.NO_MARK for v in m]
+        return cls.STATE_META.pack(
+            state['cursor_before'], state['cursor_after'],
+            state['modified_before'], state['lastchange_before'],
+            *mark(state['mark_before']), *mark(state['mark_after']))
+
+    @classmethod
+    def unpack_state(cls, data):
+        v = cls.STATE_META.unpack(data)
+        mark = lambda m: [MemoryBuffer.UNKNOWN if x == cls.NO_MARK else x for x in m]
+        return {
+            'diff': None,
+            'mark_before': mark(v[4:30]),
+            'mark_after': mark(v[30:56]),
+            'modified_before': bool(v[2]),
+            'lastchange_before': bool(v[3]),
+            'cursor_before': v[0],
+            'cursor_after': v[1],
+        }
+
+
 class BiEditor:
     """バイナリエディタのメインクラス"""
+    DEFAULT_UNDO_BUDGET = 256 << 20     # 256 MiB
     def __init__(self, termcol=''):
         self.scriptingflag = False
         self.verbose = False
@@ -1305,6 +2860,17 @@ class BiEditor:
         self.undo_stack = []  # 各エントリ: {'diff': [...], 'mark_before': [...], ...}
         self.redo_stack = []
         self.max_undo_levels = 100  # 最大undo回数
+        # undo/redo 両スタックの差分がメモリ上に持てるバイト数 (--undo-budget)。
+        # 超えたら古い状態から差分を一時ファイルのジャーナルへ退避し、
+        # 退避もできなければ古い状態を捨てる。
+        self.undo_budget = self.DEFAULT_UNDO_BUDGET
+        self.undo_journal = UndoJournal()
+        # 編集中のファイルの隣に置く永続ジャーナル (--undo-journal)。
+        # 開いている間は undo_journal も同じものを指す。
+        self.undo_history = None
+        # キー入力が続いている間に画面を描き直す最大回数/秒 (--fps)。
+        # 0 以下なら入力が途切れるまで描き直さない。
+        self.max_fps = 30
         self._undo_mark_snapshot = None    # begin_undo() 時点の mark スナップショット
         self._undo_meta_snapshot = None    # begin_undo() 時点の modified/lastchange
         self._undo_cursor_snapshot = None  # begin_undo() 時点のカーソル位置
@@ -1348,8 +2914,8 @@ class BiEditor:
                 # ('ovw', addr, old_byte, new_byte, orig_mem_len)
                 _, addr, old_byte, new_byte, orig_len = entry
                 # orig_len より短くなっていた場合も考慮して復元
-                while len(self.memory.mem) <= addr:
-                    self.memory.mem.append(0)
+                if len(self.memory.mem) <= addr:
+                    self.memory.mem += bytes(addr + 1 - len(self.memory.mem))
                 self.memory.mem[addr] = old_byte
                 # mem が拡張されていたなら縮める
                 if orig_len < len(self.memory.mem):
@@ -1357,9 +2923,9 @@ class BiEditor:
             elif op == 'ovw_region':
                 # ('ovw_region', start, old_region, new_region, orig_len)
                 _, start, old_region, new_region, orig_len = entry
-                for i, v in enumerate(old_region):
-                    if start + i < len(self.memory.mem):
-                        self.memory.mem[start + i] = v
+                end = min(start + len(old_region), len(self.memory.mem))
+                if start < end:
+                    self.memory.mem[start:end] = old_region[:end - start]
                 if orig_len < len(self.memory.mem):
                     del self.memory.mem[orig_len:]
             elif op == 'ins':
@@ -1370,6 +2936,10 @@ class BiEditor:
                 # ('del', start, data) → undo は挿入
                 _, start, data = entry
                 self.memory.mem[start:start] = data
+            elif op == 'sub':
+                # ('sub', [(pos, old_data), ...], repl) → undo は各 repl を旧データへ戻す
+                _, olds, repl = entry
+                self._apply_sub(olds, repl, True)
 
     def _apply_diff_forward(self, diff_log):
         """差分リストを順方向に適用する（redo 用）"""
@@ -1377,22 +2947,43 @@ class BiEditor:
             op = entry[0]
             if op == 'ovw':
                 _, addr, old_byte, new_byte, orig_len = entry
-                while len(self.memory.mem) <= addr:
-                    self.memory.mem.append(0)
+                if len(self.memory.mem) <= addr:
+                    self.memory.mem += bytes(addr + 1 - len(self.memory.mem))
                 self.memory.mem[addr] = new_byte
             elif op == 'ovw_region':
                 _, start, old_region, new_region, orig_len = entry
                 # new_region に合わせて拡張
-                while len(self.memory.mem) < start + len(new_region):
-                    self.memory.mem.append(0)
-                for i, v in enumerate(new_region):
-                    self.memory.mem[start + i] = v
+                if len(self.memory.mem) < start + len(new_region):
+                    self.memory.mem += bytes(start + len(new_region) - len(self.memory.mem))
+                self.memory.mem[start:start + len(new_region)] = new_region
             elif op == 'ins':
                 _, start, data = entry
                 self.memory.mem[start:start] = data
             elif op == 'del':
                 _, start, data = entry
                 del self.memory.mem[start:start + len(data)]
+            elif op == 'sub':
+                _, olds, repl = entry
+                self._apply_sub(olds, repl, False)
+
+    def _apply_sub(self, olds, repl, inverse):
+        """'sub' 差分の適用。inverse=False なら置換前のバッファの各旧データを
+        repl に、True なら置換後のバッファの各 repl を旧データへ戻す。
+        いずれも領域を断片から組み立てて1回のスライス代入で差し替える。"""
+        start = olds[0][0]
+        old_len = olds[-1][0] + len(olds[-1][1]) - start
+        new_len = old_len + len(olds) * len(repl) - sum(len(d) for _, d in olds)
+        cur = self.memory.mem[start:start + (new_len if inverse else old_len)]
+        parts = []
+        src = 0
+        prev = start
+        for pos, data in olds:
+            gap = pos - prev
+            parts.append(cur[src:src + gap])
+            parts.append(data if inverse else repl)
+            src += gap + (len(repl) if inverse else len(data))
+            prev = pos + len(data)
+        self.memory.mem[start:start + len(cur)] = b''.join(parts)
 
     def save_undo_state(self):
         """操作前に呼び出す: 差分記録を開始し mark/meta/カーソル位置をスナップショット"""
@@ -1433,10 +3024,58 @@ class BiEditor:
         self._undo_mark_snapshot = None
         self._undo_meta_snapshot = None
         self._undo_cursor_snapshot = None
+        self._push_undo(state)
+
+    def _push_undo(self, state):
+        """確定した状態を undo スタックに積み、redo スタックを捨てる"""
+        state['size'] = diff_size(state['diff'])
+        # ジャーナルに退避した位置 (offset, length)。永続ジャーナルなら今書く。
+        state['journal'] = self._history_state(state)
         self.undo_stack.append(state)
         if len(self.undo_stack) > self.max_undo_levels:
             self.undo_stack.pop(0)
         self.redo_stack = []
+        self._trim_undo()
+
+    def _state_diff(self, state):
+        """状態の差分リストを返す。ジャーナルに退避済みなら読み戻す。"""
+        if state['diff'] is None:
+            state['diff'] = decode_diff(self.undo_journal.read(state['journal']))
+        return state['diff']
+
+    def _trim_undo(self):
+        """undo/redo の差分がメモリ上で undo_budget を超えていれば、古い状態
+        (undo スタックの底から、次に redo スタックの遠い方から) の差分を
+        ジャーナルへ退避する。一度退避した差分は読み戻した後も位置を
+        覚えているので、再退避では書き直さない。ジャーナルに書けないときは
+        古い状態そのものを捨てる。"""
+        states = self.undo_stack + self.redo_stack
+        used = sum(st['size'] for st in states if st['diff'] is not None)
+        if used > self.undo_budget:
+            for st in states:
+                if used <= self.undo_budget:
+                    break
+                if st['diff'] is None:
+                    continue
+                if st['journal'] is None:
+                    try:
+                        st['journal'] = self.undo_journal.append(encode_diff(st['diff']))
+                    except OSError:
+                        break
+                st['diff'] = None
+                used -= st['size']
+            while used > self.undo_budget and (self.undo_stack or self.redo_stack):
+                st = (self.undo_stack or self.redo_stack).pop(0)
+                if st['diff'] is not None:
+                    used -= st['size']
+        if not any(st['journal'] is not None for st in self.undo_stack + self.redo_stack):
+            self.undo_journal.clear()
+
+    def undo_usage(self):
+        """undo 履歴の使用量: (undo 数, redo 数, メモリ上のバイト数, ジャーナルのバイト数)"""
+        states = self.undo_stack + self.redo_stack
+        used = sum(st['size'] for st in states if st['diff'] is not None)
+        return len(self.undo_stack), len(self.redo_stack), used, self.undo_journal.size
 
     def dec_undo(self):
         """操作が失敗したとき: 今回の差分記録を破棄する"""
@@ -1446,9 +3085,25 @@ class BiEditor:
 
     def undo(self):
         """差分を逆適用して undo を実行"""
-        if not self.undo_stack:
+        if not self._undo_state():
             self.stdmm("No more undo.")
             return False
+        self.stdmm(f"Undo. ({len(self.undo_stack)} more)")
+        return True
+
+    def redo(self):
+        """差分を順適用して redo を実行"""
+        if not self._redo_state():
+            self.stdmm("No more redo.")
+            return False
+        self.stdmm(f"Redo. ({len(self.redo_stack)} more)")
+        return True
+
+    def _undo_state(self):
+        """undo の本体: undo スタックの先頭の状態を戻す (メッセージは出さない)。
+        戻す状態が無ければ False。"""
+        if not self.undo_stack:
+            return False
 
         state = self.undo_stack.pop()
 
@@ -1460,7 +3115,9 @@ class BiEditor:
         self.redo_stack.append(state)
 
         # 差分を逆適用
-        self._apply_diff_inverse(state['diff'])
+        self._apply_diff_inverse(self._state_diff(state))
+        self._history_record(b'U')
+        self._trim_undo()
         self.memory.mark = list(state['mark_before'])
         self.memory.modified = state['modified_before']
         self.memory.lastchange = state['lastchange_before']
@@ -1472,14 +3129,12 @@ class BiEditor:
             self.display.jump(0)
         elif cur >= mem_len:
             self.display.jump(mem_len - 1)
-
-        self.stdmm(f"Undo. ({len(self.undo_stack)} more)")
         return True
 
-    def redo(self):
-        """差分を順適用して redo を実行"""
+    def _redo_state(self):
+        """redo の本体: redo スタックの先頭の状態をやり直す (メッセージは
+        出さない)。やり直す状態が無ければ False。"""
         if not self.redo_stack:
-            self.stdmm("No more redo.")
             return False
 
         state = self.redo_stack.pop()
@@ -1492,7 +3147,9 @@ class BiEditor:
         self.undo_stack.append(state)
 
         # 差分を順適用
-        self._apply_diff_forward(state['diff'])
+        self._apply_diff_forward(self._state_diff(state))
+        self._history_record(b'R')
+        self._trim_undo()
         self.memory.mark = list(state['mark_after'])
         self.memory.modified = True
         self.memory.lastchange = True
@@ -1504,10 +3161,201 @@ class BiEditor:
             self.display.jump(0)
         elif cur >= mem_len:
             self.display.jump(mem_len - 1)
-
-        self.stdmm(f"Redo. ({len(self.redo_stack)} more)")
         return True
     
+    # ------------------------------------------------------------------
+    # 永続 undo ジャーナル (--undo-journal)
+    # ------------------------------------------------------------------
+    def _file_key(self, fn):
+        """バッファと同じ内容を持つファイル fn のキー。サイズと更新時刻に、
+        バッファから間引いて取ったブロックの sha256 を添える。"""
+        try:
+            mtime = os.stat(fn).st_mtime_ns
+        except OSError:
+            mtime = 0
+        mem = self.memory.mem
+        n = len(mem)
+        blk, k = UndoHistoryFile.KEY_BLOCK, UndoHistoryFile.KEY_SAMPLES
+        h = hashlib.sha256()
+        if n <= blk * k:
+            starts = [0]
+            blk = n
+        else:
+            starts = [(n - blk) * i // (k - 1) for i in range(k)]
+        for a in starts:
+            for chunk in mem.iter_chunks(a, a + blk):
+                h.update(chunk)
+        return UndoHistoryFile.KEY.pack(n, mtime) + h.digest()
+
+    def _history_record(self, kind, *parts):
+        """永続ジャーナルにレコードを書いて本体の位置を返す。
+        書けなければ一度だけ警告し、以後は記録しない。"""
+        hist = self.undo_history
+        if hist is None or hist.failed:
+            return None
+        try:
+            return hist.record(kind, *parts)
+        except OSError as e:
+            self.stderr(f"undo journal '{hist.path}' disabled: {e.strerror or e}.")
+            return None
+
+    def _history_state(self, state):
+        """確定した状態を永続ジャーナルに書き、差分の位置を返す"""
+        if self.undo_history is None:
+            return None
+        data = encode_diff(state['diff'])
+        off = self._history_record(b'S', UndoHistoryFile.pack_state(state), data)
+        if off is None:
+            return None
+        return off + UndoHistoryFile.STATE_META.size, len(data)
+
+    def note_write(self, fn):
+        """fn へバッファ全体を書き込めたとき: 編集中のファイルなら、今の
+        undo 位置がその内容に当たることをジャーナルに残す"""
+        if self.undo_history is not None and \
+                os.path.abspath(fn) == os.path.abspath(self.filemgr.filename):
+            self._history_record(b'W', self._file_key(fn))
+
+    def open_undo_history(self, path):
+        """永続ジャーナル path を開き、前のセッションまでの undo/redo 履歴を
+        つなぐ。戻り値: (成否, メッセージ)
+
+        ジャーナルを先頭から再生し、今のファイルと同じキー (サイズ・更新
+        時刻・間引いた内容のハッシュ) を持つ最後の B/W レコードの位置を
+        現在位置とする(その後の履歴が同じ流れの
+        まま続いていれば redo として残す)。Q で終わっていない、つまり前回
+        異常終了していたら、最後に記録された位置まで undo/redo をたどって
+        編集を復元する。ジャーナルは max_undo_levels までの履歴だけを
+        書き直したものに置き換える。どの B/W とも合わない前のジャーナルは
+        <path>.old に残す。"""
+        digest = self._file_key(self.filemgr.filename)
+        try:
+            old = UndoHistoryFile(path) if os.path.exists(path) else None
+        except ValueError as e:
+            return False, f"{e}."
+        except OSError as e:
+            return False, f"Cannot open '{path}': {e.strerror or e}."
+        meta_size = UndoHistoryFile.STATE_META.size
+        tmp = path + '.new'
+        new = None
+        try:
+            # 再生: states が記録された状態の並び、pos が現在位置
+            states, pos, match, clean = [], 0, None, False
+            if old is not None:
+                for kind, off, n in old.records():
+                    clean = kind == b'Q'
+                    if kind == b'S':
+                        st = UndoHistoryFile.unpack_state(old.read((off, meta_size)))
+                        st['journal'] = (off + meta_size, n - meta_size)
+                        del states[pos:]
+                        states.append(st)
+                        pos += 1
+                    elif kind == b'U':
+                        pos = max(pos - 1, 0)
+                    elif kind == b'R':
+                        pos = min(pos + 1, len(states))
+                    elif kind in (b'B', b'W') and old.read((off, n)) == digest:
+                        match = (list(states), pos)
+            if match is None:
+                branch, at = [], 0
+            else:
+                branch, at = match
+                if len(states) >= at and all(a is b for a, b in zip(states, branch[:at])):
+                    branch = states
+            first = max(0, at - self.max_undo_levels)
+            new = UndoHistoryFile(tmp, create=True)
+            kept = []
+            for i, st in enumerate(branch[first:], first):
+                # 前のセッションの未保存フラグは当時のファイルに対するもの。
+                # 今のファイルと同じ内容になるのは位置 at だけ。
+                st = dict(st, modified_before=i != at, lastchange_before=i != at)
+                data = old.read(st['journal'])
+                off = new.record(b'S', UndoHistoryFile.pack_state(st), data)
+                st.update(journal=(off + meta_size, len(data)), size=len(data))
+                kept.append(st)
+            for _ in range(len(branch) - at):
+                new.record(b'U')
+            new.record(b'B', digest)
+        except (OSError, ValueError) as e:
+            if old is not None:
+                old.close()
+            if new is not None:
+                new.close()
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+            return False, f"Cannot read undo journal '{path}': {getattr(e, 'strerror', None) or e}."
+
+        msg = None
+        if old is not None and match is None:
+            # 別の内容に対する履歴: 消さずに退けておく
+            old.close()
+            old = None
+            kept_as = f"{path}.old"
+            n = 0
+            while os.path.exists(kept_as):
+                n += 1
+                kept_as = f"{path}.old.{n}"
+            try:
+                os.replace(path, kept_as)
+            except OSError as e:
+                new.close()
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+                return False, f"Cannot move undo journal '{path}' aside: {e.strerror or e}."
+            msg = f"Undo journal '{path}' does not match the file; kept it as '{kept_as}' and started a new one."
+
+        self.undo_journal.close()
+        self.undo_history = self.undo_journal = new
+        self.undo_stack = kept[:at - first]
+        self.redo_stack = kept[at - first:][::-1]
+        if match is not None and not clean and (branch is not states or pos != at):
+            # 異常終了: branch の at から states の pos まで、共通の流れまで
+            # undo してから記録どおりにたどり直す
+            k = 0
+            while k < min(at, pos) and states[k] is branch[k]:
+                k += 1
+            if at - k > len(self.undo_stack):
+                msg = f"Undo journal '{path}' is too long to recover; changes after the last write are lost."
+            else:
+                try:
+                    # 途中の Undo./Redo. は出さず、復元の要約だけを出す
+                    for _ in range(at - k):
+                        self._undo_state()
+                    if branch is states:
+                        for _ in range(pos - k):
+                            self._redo_state()
+                    else:
+                        for st in states[k:]:
+                            diff = decode_diff(old.read(st['journal']))
+                            self._apply_diff_forward(diff)
+                            self._push_undo(dict(st, diff=diff))
+                        for _ in range(len(states) - pos):
+                            self._undo_state()
+                    msg = f"Recovered {at - k + pos - k} changes from undo journal '{path}'."
+                except (OSError, ValueError) as e:
+                    msg = f"Undo journal '{path}' is broken ({e}); recovery stopped."
+                self.memory.modified = True
+                self.memory.lastchange = True
+        if old is not None:
+            old.close()
+        try:
+            os.replace(tmp, path)
+            new.path = path
+        except OSError as e:
+            return False, f"Cannot replace '{path}': {e.strerror or e}."
+        return True, msg
+
+    def close_undo_history(self, clean=True):
+        """永続ジャーナルを閉じる。clean なら正常終了の印を残す
+        (残さなければ次に開いたとき編集を復元する)。"""
+        if self.undo_history is None:
+            return
+        if clean:
+            self._history_record(b'Q')
+        self.undo_history.close()
+        self.undo_history = None
+        self.undo_journal = UndoJournal()
+
     def stderr(self, s):
         self.error_occurred = True
         self.display.stderr(s, self.scriptingflag, self.verbose)
@@ -1531,9 +3379,11 @@ class BiEditor:
         self.term.clear()
     
     def invoke_shell(self, line):
+        self.display.invalidate()
         self.term.color(7)
         print()
-        os.system(line.lstrip())
+        with Terminal.cooked_mode():
+            os.system(line.lstrip())
         self.term.color(4)
         print("[ Hit any key to return ]", end='', flush=True)
         Terminal.getch()
@@ -1592,12 +3442,25 @@ class BiEditor:
 
         # @exec はバッファ(mem)を任意に書き換えられるが、通常コマンドと違い
         # MemoryBuffer.setmem() を経由しないため差分ログに乗らない。
-        # そこで exec 実行前のバッファ全体をスナップショットしておき、
+        # そこで exec 実行前のバッファをスナップショットしておき、
         # 実行後に旧バッファと比較して差分を undo_stack に積む。
         # [変更] 従来は対話モードのみ有効(scripting 中は undo を取らない)
         # だったが、save_undo_state/commit_undo と同じ理由で撤去し、
         # スクリプト実行中も同じ経路で記録する。
-        buf_before = list(self.memory.mem)
+        # スナップショットはピース列の複製だけでデータはコピーしない。
+        # コードが mem を mem + b"..", mem.replace(...), re.sub(..., mem)
+        # のような bytes 系の書き方で使うときは、それがそのまま使えるよう
+        # 従来どおり bytearray に実体化したものを mem として渡し、実行後に
+        # 比較して変わった区間だけをピーステーブルへ書き戻す。それ以外
+        # (mem[i] / mem[a:b] / len(mem) だけを使うコード、setmem() や過去の
+        # @ で定義した関数の呼び出し等) はピーステーブルを直接触るので、
+        # 変更箇所を編集履歴 (changed_since) から得て、比較をその範囲
+        # だけで済ませる (_mem_needs_bytes 参照)。
+        buf_obj = self.memory.mem
+        buf_before = buf_obj.snapshot()
+        version_before = buf_obj.version
+        if _mem_needs_bytes(line, 'exec'):
+            globals()['mem'] = bytearray(buf_obj)
         undo_enabled = True
         if undo_enabled:
             mark_before = list(self.memory.mark)
@@ -1619,55 +3482,97 @@ class BiEditor:
                 self.term.clear()
                 self.display.repaint(self.filemgr.filename)
         except Exception as e:
+            # 途中までの変更はバッファに残す (undo には積まない)
+            self._exec_writeback(buf_obj, buf_before, version_before)
             self.stderr(f"python exec() error: {e}")
             return
 
-        # exec() が mem をリスト等の非bytearrayに差し替えた場合に備え型を正規化する
-        # (self.mem のセッターが bytearray へ変換する)。
-        self.memory.mem = self.memory.mem
+        diff_log = self._exec_writeback(buf_obj, buf_before, version_before)
         # バッファが実際に変化した場合のみ modified/lastchange を更新する
-        if list(self.memory.mem) != buf_before:
+        if diff_log:
             self.memory.modified   = True
             self.memory.lastchange = True
 
         # exec 前後でバッファが変化していれば差分を undo_stack に記録する。
-        if undo_enabled:
-            buf_after = list(self.memory.mem)
-            if buf_after != buf_before:
-                diff_log = self._build_exec_diff(buf_before, buf_after)
-                if diff_log:
-                    state = {
-                        'diff': diff_log,
-                        'mark_before': mark_before,
-                        'mark_after': list(self.memory.mark),
-                        'modified_before': meta_before[0],
-                        'lastchange_before': meta_before[1],
-                        'cursor_before': cursor_before,
-                        'cursor_after': self.display.fpos(),
-                    }
-                    self.undo_stack.append(state)
-                    if len(self.undo_stack) > self.max_undo_levels:
-                        self.undo_stack.pop(0)
-                    self.redo_stack = []
-
-    def _build_exec_diff(self, before, after):
+        if undo_enabled and diff_log:
+            state = {
+                'diff': diff_log,
+                'mark_before': mark_before,
+                'mark_after': list(self.memory.mark),
+                'modified_before': meta_before[0],
+                'lastchange_before': meta_before[1],
+                'cursor_before': cursor_before,
+                'cursor_after': self.display.fpos(),
+            }
+            self._push_undo(state)
+
+    EXEC_CMP_CHUNK = 1 << 20    # exec 前後の比較で一度に読むバイト数
+
+    def _exec_writeback(self, buf_obj, buf_before, version_before):
+        """exec 後のグローバル mem を exec 前のバッファ buf_obj に書き戻し、
+        undo 用の差分リストを返す。mem が bytearray やリスト等に差し替わって
+        いれば全体を比べ、変わった区間だけを buf_obj に適用する。"""
+        result = globals()['mem']
+        globals()['mem'] = buf_obj
+        if result is buf_obj:
+            # 同じバッファへの変更: 編集履歴から変わりうる範囲を得る
+            # (履歴を遡れなければ None = 全体を比較)
+            span = buf_obj.changed_since(version_before)
+            if span == (0, 0, 0):
+                return []
+            return self._build_exec_diff(buf_before, buf_obj, span)
+        if not isinstance(result, (bytes, bytearray, PieceTable)):
+            result = bytes(result)
+        diff_log = self._build_exec_diff(buf_before, result)
+        self._apply_diff_forward(diff_log)
+        return diff_log
+
+    def _common_len(self, x, y, i, j, limit, reverse=False):
+        """x の位置 i と y の位置 j から (reverse なら i, j の手前へ向かって)
+        内容が一致し続けるバイト数を limit を上限に返す。EXEC_CMP_CHUNK ずつ
+        読んで比較し、食い違った断片の中だけ二分探索で境目を探す。"""
+        done = 0
+        while done < limit:
+            n = min(self.EXEC_CMP_CHUNK, limit - done)
+            if reverse:
+                a = x[i - done - n:i - done]
+                b = y[j - done - n:j - done]
+            else:
+                a = x[i + done:i + done + n]
+                b = y[j + done:j + done + n]
+            if a == b:
+                done += n
+                continue
+            a, b = memoryview(a), memoryview(b)
+            lo, hi = 0, n       # 一致している長さは lo 以上 hi 未満
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if (a[n - mid:] == b[n - mid:]) if reverse else (a[:mid] == b[:mid]):
+                    lo = mid
+                else:
+                    hi = mid
+            return done + lo
+        return limit
+
+    def _build_exec_diff(self, before, after, span=None):
         """exec 前後のバッファを比較し、undo 用の差分リストを生成する。
         共通の先頭・末尾を除いた中央の変化区間のみを ovw_region / ins / del
         で表現する。_apply_diff_inverse / _apply_diff_forward と互換。
+        span=(a, b, n) は「変更前の [a, b) が変更後の [a, a+n) になり、その外は
+        同じ」という範囲 (PieceTable.changed_since の値)。None なら全体を比べる。
         """
         lb, la = len(before), len(after)
+        a, b, n = span if span is not None else (0, lb, la)
         # 先頭の共通部分長
-        head = 0
-        while head < lb and head < la and before[head] == after[head]:
-            head += 1
+        head = a + self._common_len(before, after, a, a, min(b, a + n) - a)
         # 末尾の共通部分長 (head と重ならない範囲で)
-        tail = 0
-        while (tail < lb - head and tail < la - head and
-               before[lb - 1 - tail] == after[la - 1 - tail]):
-            tail += 1
-        old_mid = before[head:lb - tail]
-        new_mid = after[head:la - tail]
+        tail = (lb - b) + self._common_len(before, after, b, a + n, min(b, a + n) - head,
+                                           reverse=True)
+        old_mid = bytes(before[head:lb - tail])
+        new_mid = bytes(after[head:la - tail])
         diff = []
+        if not old_mid and not new_mid:
+            return diff     # 書き込みはあったが内容は変わっていない
         if len(old_mid) == len(new_mid):
             # 長さ不変: 領域上書き1エントリで表現
             # ('ovw_region', start, old_region, new_region, orig_len)
@@ -1684,13 +3589,23 @@ class BiEditor:
         """フルスクリーンエディタモード"""
         stroke = False
         ch = ''
+        next_frame = 0.0
         
         while True:
             # self.cp はグローバル cp を直接指すプロパティなので同期不要
             self.cp = self.display.fpos()
-            self.display.repaint(self.filemgr.filename)
-            self.display.printdata()
-            self.term.locate(self.display.curx // 2 * 3 + 13 + (self.display.curx & 1), self.display.cury + 3)
+            # キーリピートや貼り付けで次のキーがもう届いていれば、描画は
+            # 省いて先にキーを処理する(入力が途切れたら描く)。キーが
+            # 途切れなくても max_fps の間隔で途中経過は描く。
+            now = time.monotonic()
+            if (not Terminal.input_pending()
+                    or (self.max_fps > 0 and now >= next_frame)):
+                with self.term.frame():
+                    self.display.repaint(self.filemgr.filename)
+                    self.display.printdata()
+                    self.term.locate(self.display.curx // 2 * 3 + 13 + (self.display.curx & 1), self.display.cury + 3)
+                if self.max_fps > 0:
+                    next_frame = now + 1.0 / self.max_fps
             ch = Terminal.getch()
             if ch == '':
                 # 標準入力がEOFに達した(端末切断等)。sys.stdin.read(1)は以後
@@ -1699,7 +3614,7 @@ class BiEditor:
                 # int("0x"+"",16)がValueErrorを起こす問題を避けるため、
                 # ここで明示的に異常終了として扱う(main()側で緊急保存される)。
                 raise EOFError("stdin reached EOF (terminal disconnected?)")
-            self.display.clrmm()
+            self.display.clear_message()
             self.search.nff = True
             
             # エスケープシーケンス処理
@@ -1733,40 +3648,44 @@ class BiEditor:
             # regexp/smem 未設定を検知して "No data to search." を出しており、
             # これと同じメッセージを出すよう揃える。
             if ch == 'n':
-                pos = self.search.searchnext(self.display.fpos() + 1, len(self.memory))
-                if pos is not None and pos is not False:
-                    # ハイライト範囲が空の場合、全マッチを再検索してハイライト
-                    if not self.display.highlight_ranges:
-                        matches = self.search.search_all(len(self.memory))
-                        if matches:
-                            self.display.highlight_ranges = matches
-                    self.display.jump(pos)
-                elif pos is False:
-                    self.stderr("No data to search.")
-                elif pos is None:
-                    self.stderr("Not found.")
+                with Terminal.interruptible():
+                    pos = self.search.searchnext(self.display.fpos() + 1, len(self.memory))
+                    if pos is not None and pos is not False:
+                        # ハイライト範囲が空の場合、全マッチを再検索してハイライト
+                        if not self.display.highlight_ranges:
+                            matches = self.search.search_all(len(self.memory))
+                            if matches:
+                                self.display.highlight_ranges = matches
+                        self.display.jump(pos)
+                    elif pos is False:
+                        self.stderr("No data to search.")
+                    elif pos is None:
+                        self.stderr("Not found.")
                 continue
             elif ch == 'N':
-                pos = self.search.searchlast(self.display.fpos() - 1, len(self.memory))
-                if pos is not None and pos is not False:
-                    # ハイライト範囲が空の場合、全マッチを再検索してハイライト
-                    if not self.display.highlight_ranges:
-                        matches = self.search.search_all(len(self.memory))
-                        if matches:
-                            self.display.highlight_ranges = matches
-                    self.display.jump(pos)
-                elif pos is False:
-                    self.stderr("No data to search.")
-                elif pos is None:
-                    self.stderr("Not found.")
+                with Terminal.interruptible():
+                    pos = self.search.searchlast(self.display.fpos() - 1, len(self.memory))
+                    if pos is not None and pos is not False:
+                        # ハイライト範囲が空の場合、全マッチを再検索してハイライト
+                        if not self.display.highlight_ranges:
+                            matches = self.search.search_all(len(self.memory))
+                            if matches:
+                                self.display.highlight_ranges = matches
+                        self.display.jump(pos)
+                    elif pos is False:
+                        self.stderr("No data to search.")
+                    elif pos is None:
+                        self.stderr("Not found.")
                 continue
             
             # Undo/Redo
             elif ch == 'u':
-                self.undo()
+                with Terminal.interruptible():
+                    self.undo()
                 continue
             elif ch == chr(18) or ch=='U':  # Ctrl+R
-                self.redo()
+                with Terminal.interruptible():
+                    self.redo()
                 continue
             
             # スクロールコマンド
@@ -1844,10 +3763,13 @@ class BiEditor:
             
             # ファイル操作 (Z: :wq! 相当、パーシャル対応、失敗でも終了)
             elif ch == 'Z':
-                if g_partial.active:
-                    success, msg = self.filemgr.writefile_partial(self.filemgr.filename)
-                else:
-                    success, msg = self.filemgr.writefile(self.filemgr.filename)
+                with Terminal.interruptible():
+                    if g_partial.active:
+                        success, msg = self.filemgr.writefile_partial(self.filemgr.filename)
+                    else:
+                        success, msg = self.filemgr.writefile(self.filemgr.filename)
+                        if success:
+                            self.note_write(self.filemgr.filename)
                 self.memory.lastchange = False
                 if not success:
                     self.stderr(msg)
@@ -1870,7 +3792,8 @@ class BiEditor:
             
             # 検索
             elif ch == '/':
-                self.do_search()
+                with Terminal.interruptible():
+                    self.do_search()
                 continue
             elif ch == "'":
                 ch = Terminal.getch().lower()
@@ -1943,7 +3866,8 @@ class BiEditor:
                 self.display.disp_curpos()
                 # コマンド実行前のファイル長を保存
                 before_len = len(self.memory.mem)
-                f = self.commandln()
+                with Terminal.interruptible():
+                    f = self.commandln()
                 # コマンド実行後にファイル長が変わった場合のみハイライトをクリア
                 if len(self.memory.mem) != before_len:
                     self.display.highlight_ranges = []
@@ -1955,6 +3879,7 @@ class BiEditor:
     
     def do_search(self):
         """検索実行"""
+        self.display.invalidate()    # readline のプロンプト
         self.display.disp_curpos()
         self.term.locate(0, self.display.BOTTOMLN)
         self.term.color(7)
@@ -1980,7 +3905,7 @@ class BiEditor:
             # 取り違えないよう、ここでパターンを検証して明示的にエラー表示する。
             # 不正時は検索状態を変更せず、直前の有効なパターンを保持する。
             try:
-                re.compile(s)
+                self.search.compile_regex(s)
             except re.error as e:
                 self.stderr(f"Invalid regular expression: {e}")
                 return False
@@ -2028,11 +3953,16 @@ class BiEditor:
 
     def commandln(self):
         """コマンドライン入力"""
+        # プロンプトやコマンドの出力 (readline・exec・表示系コマンド) は
+        # 画面のどこに書かれるか分からない
+        self.display.invalidate()
         self.term.locate(0, self.display.BOTTOMLN)
         self.term.color(7)
         readline.set_pre_input_hook(lambda: (readline.insert_text(''), readline.redisplay()))
         line = self.history.getln(':', "command").lstrip()
-        return self.commandline(line)
+        result = self.commandline(line)
+        self.display.invalidate()
+        return result
     
     def _split_statements(self, line):
         """'::'区切りでステートメントに分割（'\::'はリテラルの'::'）"""
@@ -2095,7 +4025,7 @@ class BiEditor:
         if line == '':
             return -1
         
-        # エンディアン切り替え
+        # エンディアン / 正規表現モード切り替え
         if line[0] == '_':
             if line == '_big':
                 self.endian = 'big'
@@ -2103,8 +4033,14 @@ class BiEditor:
             elif line == '_little':
                 self.endian = 'little'
                 self.stdmm("Switched to little endian.")
+            elif line == '_utf8':
+                self.search.utf8 = True
+                self.stdmm("Regular expressions match UTF-8 text.")
+            elif line == '_bytes':
+                self.search.utf8 = False
+                self.stdmm("Regular expressions match raw bytes.")
             else:
-                self.stderr("Unknown command. Use '_big' or '_little'.")
+                self.stderr("Unknown command. Use '_big', '_little', '_utf8' or '_bytes'.")
             return -1
 
         # 型付き数値表示 (?s/?i/?l/?q/?f/?d/?Q/?us/?ui/?ul) — 範囲なし版はここから parse_range_command へ
@@ -2125,6 +4061,8 @@ class BiEditor:
                 success, msg = self.filemgr.writefile_partial(self.filemgr.filename)
             else:
                 success, msg = self.filemgr.writefile(self.filemgr.filename)
+                if success:
+                    self.note_write(self.filemgr.filename)
             if success:
                 self.memory.lastchange = False
                 self.stdmm("File written and quit.")
@@ -2140,6 +4078,11 @@ class BiEditor:
         elif line == 'U' or line == 'redo':
             self.redo()
             return -1
+        elif line == 'u?' or line == 'undoinfo':
+            n_undo, n_redo, used, spilled = self.undo_usage()
+            self.stdmm(f"undo:{n_undo} redo:{n_redo} memory:{format_size(used)} "
+                       f"journal:{format_size(spilled)} budget:{format_size(self.undo_budget)}")
+            return -1
 
         # ファイル書き込み
         elif line[0] == 'w':
@@ -2157,6 +4100,8 @@ class BiEditor:
             fname_specified = len(line) >= 2 and line[1:].lstrip() != ''
             if fname_specified:
                 success, msg = self.filemgr.writefile(line[1:].lstrip())
+                if success:
+                    self.note_write(line[1:].lstrip())
             elif g_partial.active:
                 success, msg = self.filemgr.writefile_partial(self.filemgr.filename)
                 if success:
@@ -2165,6 +4110,7 @@ class BiEditor:
                 success, msg = self.filemgr.writefile(self.filemgr.filename)
                 if success:
                     self.memory.lastchange = False
+                    self.note_write(self.filemgr.filename)
             if msg:
                 if success:
                     self.stdmm(msg)
@@ -2350,100 +4296,369 @@ class BiEditor:
         # 各種コマンドの処理
         return self.execute_command(line, idx, x, x2, xf, xf2)
     
-    def cmd_typed_display(self, x, x2, xf, xf2, type_char):
-        """型付き数値表示コマンド (?s/?i/?l/?q/?f/?d/?Q)"""
-        import struct, ctypes
-
-        size_map = {'s': 2, 'i': 4, 'l': 8, 'q': 16, 'f': 4, 'd': 8, 'Q': 16,
-                    'us': 2, 'ui': 4, 'ul': 8}
-        label_map = {'s': 'int16', 'i': 'int32', 'l': 'int64', 'q': 'int128',
-                     'f': 'float32', 'd': 'float64', 'Q': 'float128',
-                     'us': 'uint16', 'ui': 'uint32', 'ul': 'uint64'}
-        size = size_map[type_char]
+    # 型付き数値表示の型コード -> (バイト数, 表示名, struct の書式文字)
+    # 書式文字が None の 128 ビット型は1要素ずつ変換する
+    TYPED_FORMATS = {'s': (2, 'int16', 'h'), 'i': (4, 'int32', 'i'),
+                     'l': (8, 'int64', 'q'), 'q': (16, 'int128', None),
+                     'f': (4, 'float32', 'f'), 'd': (8, 'float64', 'd'),
+                     'Q': (16, 'float128', None),
+                     'us': (2, 'uint16', 'H'), 'ui': (4, 'uint32', 'I'),
+                     'ul': (8, 'uint64', 'Q')}
+    TYPED_CHUNK = 1 << 18       # 型付き表示で一度に変換するバイト数の目安
+    MAX_BUCKETS = 1000          # ?= の度数分布の区間数の上限
+
+    def _typed_value(self, raw, type_char):
+        """128ビット型 (?q/?Q) の1要素を表示用の文字列にする"""
+        import ctypes
         be = (self.endian == 'big')
-        endian_ch = '>' if be else '<'
-        mem_len = len(self.memory.mem)
+        try:
+            if type_char == 'q':
+                return str(int.from_bytes(raw, 'big' if be else 'little', signed=True))
+            # 128-bit float: ctypes long double (platform dependent)
+            if be:
+                raw = raw[::-1]
+            buf = (ctypes.c_ubyte * 16)(*raw)
+            ld = ctypes.cast(buf, ctypes.POINTER(ctypes.c_longdouble)).contents.value
+            return repr(ld)
+        except Exception as e:
+            return f'(error: {e})'
+
+    def _typed_numbers(self, data, type_char):
+        """data (要素サイズの倍数長) を型 type_char の数値のリストにする。
+        ホストと同じエンディアンなら memoryview.cast、違えば struct.iter_unpack で
+        まとめて変換する。128ビット型は1要素ずつ変換する。"""
+        size, _, code = self.TYPED_FORMATS[type_char]
+        if code is None:
+            order = self.endian
+            if type_char == 'q':
+                return [int.from_bytes(data[k:k + size], order, signed=True)
+                        for k in range(0, len(data), size)]
+            import ctypes
+            vals = []
+            for k in range(0, len(data), size):
+                raw = data[k:k + size]
+                if order == 'big':
+                    raw = raw[::-1]
+                buf = (ctypes.c_ubyte * 16)(*raw)
+                vals.append(ctypes.cast(buf, ctypes.POINTER(ctypes.c_longdouble)).contents.value)
+            return vals
+        if self.endian == sys.byteorder and struct.calcsize(code) == size:
+            return memoryview(data).cast(code).tolist()
+        endian_ch = '>' if self.endian == 'big' else '<'
+        return [v for (v,) in struct.iter_unpack(endian_ch + code, data)]
+
+    def _typed_values(self, data, type_char):
+        """data (要素サイズの倍数長) を型 type_char の値の表示文字列の並びにする
+        (float は str と repr が同じなので区別しない)"""
+        size, _, code = self.TYPED_FORMATS[type_char]
+        if code is None:
+            return [self._typed_value(data[k:k + size], type_char)
+                    for k in range(0, len(data), size)]
+        return map(str, self._typed_numbers(data, type_char))
+
+    def _typed_chunks(self, start, end, type_char):
+        """start から end までにバッファ内で丸ごと収まる要素を、
+        TYPED_CHUNK バイト程度ずつ数値のリストにして順に返す(ジェネレータ)"""
+        size = self.TYPED_FORMATS[type_char][0]
+        count = (end - start) // size + 1 if end >= start else 0
+        whole = min(count, max(0, (len(self.memory.mem) - start) // size))
+        step = max(1, self.TYPED_CHUNK // size)
+        for k in range(0, whole, step):
+            pos = start + k * size
+            n = min(step, whole - k)
+            yield self._typed_numbers(self.memory.mem[pos:pos + n * size], type_char)
+
+    def typed_stats(self, start, end, type_char, buckets=0):
+        """start から end までの型 type_char の値の統計を返す。
+        戻り値は (件数, 最小, 最大, 合計, 平均, 標準偏差, NaN の件数, 度数分布)。
+        要素ごとの文字列は作らず、チャンク単位で min/max/sum と、最初の値からの
+        差の和・二乗和 (桁落ちを避けるため) を C 実装の組み込み関数で集計する。
+        整数は厳密に、浮動小数点数は math.fsum で丸め誤差なく足し、inf を
+        含めば合計・平均・標準偏差も inf / nan になる。二乗和だけがあふれた
+        ときは最大の絶対値で割ってもう一度読み直す。
+        buckets > 0 なら最小〜最大を等分した度数分布 [(下限, 上限, 件数), ...] も
+        作る(範囲が決まってからもう一度だけ読み直す。範囲が有限でなければ
+        作らない)。値が1つも無ければ None、NaN しか無ければ件数 0 (最小・
+        最大・平均・標準偏差は None) を返す。"""
+        is_float = type_char in ('f', 'd', 'Q')
+        n = nans = 0
+        lo = hi = shift = None
+        total, dsum, dsq = [], [], []
+        add = self._fsum if is_float else sum
+        for vals in self._typed_chunks(start, end, type_char):
+            if is_float:
+                k = len(vals)
+                vals = list(itertools.filterfalse(math.isnan, vals))
+                nans += k - len(vals)
+            if not vals:
+                continue
+            if shift is None:
+                shift = lo = hi = vals[0]
+            lo = min(lo, min(vals))
+            hi = max(hi, max(vals))
+            total.append(add(vals))
+            d = list(map(operator.sub, vals, itertools.repeat(shift)))
+            dsum.append(add(d))
+            dsq.append(add(map(operator.mul, d, d)))
+            n += len(vals)
+        if n == 0:
+            return (0, None, None, 0, None, None, nans, []) if nans else None
+        total, dsum, dsq = add(total), add(dsum), add(dsq)
+        mean = total / n
+        if not is_float:
+            sd = math.sqrt((dsq * n - dsum * dsum) / (n * n))
+        else:
+            var = (dsq - dsum * dsum / n) / n
+            if math.isfinite(var):
+                sd = math.sqrt(max(0.0, var))     # 丸めでわずかに負になりうる
+            elif math.isfinite(lo) and math.isfinite(hi) and lo != hi:
+                sd = self._scaled_stddev(start, end, type_char, shift, max(abs(lo), abs(hi)), n)
+            else:
+                sd = math.sqrt(var) if var > 0 else math.nan
+        hist = []
+        if buckets > 0 and math.isfinite(hi - lo):
+            if hi == lo:
+                buckets = 1
+            width = (hi - lo) / buckets
+            edges = [lo + width * i for i in range(1, buckets)]
+            counts = [0] * buckets
+            for vals in self._typed_chunks(start, end, type_char):
+                if is_float:
+                    vals = itertools.filterfalse(math.isnan, vals)
+                for b, c in collections.Counter(map(bisect.bisect_right,
+                                                    itertools.repeat(edges), vals)).items():
+                    counts[b] += c
+            bounds = [lo] + edges + [hi]
+            hist = [(bounds[i], bounds[i + 1], counts[i]) for i in range(buckets)]
+        return n, lo, hi, total, mean, sd, nans, hist
 
+    @staticmethod
+    def _fsum(values):
+        """math.fsum。inf と -inf が混ざれば nan、和があふれれば ±inf を返す
+        (例外にしない)"""
+        values = list(values)
+        try:
+            return math.fsum(values)
+        except ValueError:
+            return math.nan
+        except OverflowError:
+            # 途中の和だけがあふれた: 2 のべきで縮めて足してから戻す
+            # (縮めた和はあふれない。本当の和があふれていれば inf になる)
+            scale = 2.0 ** len(values).bit_length()
+            return math.fsum(v / scale for v in values) * scale
+
+    def _scaled_stddev(self, start, end, type_char, shift, scale, n):
+        """二乗和があふれた有限の浮動小数点数の標準偏差を、値を scale で
+        割って計算し直す"""
+        dsum, dsq = [], []
+        for vals in self._typed_chunks(start, end, type_char):
+            d = [v / scale - shift / scale for v in vals if not math.isnan(v)]
+            dsum.append(self._fsum(d))
+            dsq.append(self._fsum(map(operator.mul, d, d)))
+        dsum, dsq = self._fsum(dsum), self._fsum(dsq)
+        return math.sqrt(max(0.0, (dsq - dsum * dsum / n) / n)) * scale
+
+    def typed_blocks(self, start, end, type_char):
+        """start から end までの型付き数値表示の行を、改行付きでまとめた
+        文字列のブロックとして順に返す(ジェネレータ)。
+        バッファ末尾で要素が欠ける位置は ~~~~~~~~ と表示する。"""
+        size, label, _ = self.TYPED_FORMATS[type_char]
+        tag = f"({label}) "
+        count = (end - start) // size + 1 if end >= start else 0
+        # バッファ内に丸ごと収まる要素の数
+        whole = min(count, max(0, (len(self.memory.mem) - start) // size))
+        step = max(1, self.TYPED_CHUNK // size)
+        for k in range(0, whole, step):
+            n = min(step, whole - k)
+            pos = start + k * size
+            data = self.memory.mem[pos:pos + n * size]
+            lines = [f"{p:08X}: {tag}{v}" for p, v in
+                     zip(range(pos, pos + n * size, size), self._typed_values(data, type_char))]
+            lines.append('')
+            yield "\n".join(lines)
+        if whole < count:
+            yield "".join(f"{start + k * size:08X}: {tag}~~~~~~~~\n"
+                          for k in range(whole, count))
+
+    def cmd_typed_display(self, x, x2, xf, xf2, type_char):
+        """型付き数値表示コマンド (?s/?i/?l/?q/?f/?d/?Q)"""
         start = int(x)
         end   = int(x2) if xf2 else start
 
-        lines_out = []
-        pos = start
-        while pos <= end:
-            if len(self.memory.mem)>=pos+size:
-                raw = bytes([self.memory.readmem(pos + i) for i in range(size)])
+        if self.scriptingflag:
+            if self.verbose or self.cmdmode:
+                # 行をためずにブロック単位で書き出す(パイプが閉じたら捨てる)
                 try:
-                    if type_char == 's':
-                        val = struct.unpack(endian_ch + 'h', raw)[0]
-                        s = str(val)
-                    elif type_char == 'i':
-                        val = struct.unpack(endian_ch + 'i', raw)[0]
-                        s = str(val)
-                    elif type_char == 'l':
-                        val = struct.unpack(endian_ch + 'q', raw)[0]
-                        s = str(val)
-                    elif type_char == 'q':
-                        val = int.from_bytes(raw, 'big' if be else 'little', signed=True)
-                        s = str(val)
-                    elif type_char == 'f':
-                        val = struct.unpack(endian_ch + 'f', raw)[0]
-                        s = repr(val)
-                    elif type_char == 'd':
-                        val = struct.unpack(endian_ch + 'd', raw)[0]
-                        s = repr(val)
-                    elif type_char == 'Q':
-                        # 128-bit float: ctypes long double (platform dependent)
-                        if be:
-                            raw = raw[::-1]
-                        buf = (ctypes.c_ubyte * 16)(*raw)
-                        ld = ctypes.cast(buf, ctypes.POINTER(ctypes.c_longdouble)).contents.value
-                        s = repr(ld)
-                    elif type_char == 'us':
-                        val = struct.unpack(endian_ch + 'H', raw)[0]
-                        s = str(val)
-                    elif type_char == 'ui':
-                        val = struct.unpack(endian_ch + 'I', raw)[0]
-                        s = str(val)
-                    elif type_char == 'ul':
-                        val = struct.unpack(endian_ch + 'Q', raw)[0]
-                        s = str(val)
-                except Exception as e:
-                    s = f'(error: {e})'
-            else:
-                s='~~~~~~~~'
-            lines_out.append(f"{pos:08X}: ({label_map[type_char]}) {s}")
-            pos += size
-            if pos > end and end != start:
-                break
+                    wrote = False
+                    for block in self.typed_blocks(start, end, type_char):
+                        sys.stdout.write(block)
+                        wrote = True
+                    if not wrote:
+                        sys.stdout.write("\n")
+                    sys.stdout.flush()
+                except BrokenPipeError:
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, sys.stdout.fileno())
+                    os.close(devnull)
+        else:
+            self._show_lines(''.join(self.typed_blocks(start, end, type_char)).splitlines())
+        return -1
+
+    def _show_lines(self, lines_out):
+        """対話モードで結果の行を最下行に表示してキー入力を待つ。
+        1行ならメッセージ行に、複数行なら画面下に流して表示する。"""
+        self.display.clrmm()
+        self.term.color(6)
+        self.term.locate(0, self.display.BOTTOMLN)
+        # 複数行は1行にまとめて表示、長ければスクロール
+        if len(lines_out) == 1:
+            print(lines_out[0], end='', flush=True)
+        else:
+            self.term.locate(0,self.display.BOTTOMLN+1)
+            # 複数: 画面下に表示してキー待ち
+            print("", flush=True)
+            for ln in lines_out:
+                print(ln)
+            self.term.color(4)
+            print("[ Hit any key ]", end='', flush=True)
+            Terminal.getch()
+            self.term.clear()
+            return
+        Terminal.getch()
+        self.term.locate(0, self.display.BOTTOMLN)
+        print(" " * 80, end='', flush=True)
 
-        output = '\n'.join(lines_out)
+    def cmd_typed_stats(self, x, x2, xf, xf2, spec):
+        """型付き数値の統計コマンド: [start,end]?=<型>[*<区間数>]
+
+        ?s/?f などと同じ型コードとエンディアンで範囲内の値を読み、
+        件数・最小・最大・合計・平均・標準偏差を表示する。*<区間数> (10進) を
+        付けると最小〜最大を等分した度数分布も表示する。"""
+        type_char, _, b = spec.partition('*')
+        if type_char not in self.TYPED_FORMATS or (b and not b.isdigit()):
+            self.stderr("Usage: [start,end]?=<s|i|l|q|f|d|Q|us|ui|ul>[*<buckets>]")
+            return -1
+        buckets = int(b) if b else 0
+        if buckets > self.MAX_BUCKETS:
+            self.stderr(f"Too many buckets (max {self.MAX_BUCKETS}).")
+            return -1
+        start = int(x)
+        end   = int(x2) if xf2 else start
+        label = self.TYPED_FORMATS[type_char][1]
+        st = self.typed_stats(start, end, type_char, buckets)
+        if st is None:
+            self.stderr("No values in range.")
+            return -1
+        n, lo, hi, total, mean, sd, nans, hist = st
+        if n == 0:
+            lines_out = [f"{start:08X}-{end:08X}: ({label}) count:0 nan:{nans} (all values are NaN)"]
+        else:
+            lines_out = [f"{start:08X}-{end:08X}: ({label}) count:{n} min:{lo} max:{hi} "
+                         f"sum:{total} mean:{mean} stddev:{sd}" + (f" nan:{nans}" if nans else "")]
+            if buckets > 0 and not math.isfinite(hi - lo):
+                lines_out.append("  (histogram skipped: the range of values is not finite)")
+        edge = lambda v: f"{v:.6g}" if isinstance(v, float) else str(v)
+        labels = [f"[{edge(a)}, {edge(z)}{']' if i == len(hist) - 1 else ')'}"
+                  for i, (a, z, _) in enumerate(hist)]
+        w = max(map(len, labels), default=0)
+        top = max((c for _, _, c in hist), default=0)
+        for label_, (_, _, c) in zip(labels, hist):
+            bar = '*' * (c * 40 // top if top else 0)
+            lines_out.append(f"  {label_:<{w}} {c:>10} {bar}".rstrip())
 
         if self.scriptingflag:
             if self.verbose or self.cmdmode:
-                print(output)
+                print('\n'.join(lines_out))
         else:
-            self.display.clrmm()
-            self.term.color(6)
-            self.term.locate(0, self.display.BOTTOMLN)
-            # 複数行は1行にまとめて表示、長ければスクロール
-            if len(lines_out) == 1:
-                print(lines_out[0], end='', flush=True)
-            else:
-                self.term.locate(0,self.display.BOTTOMLN+1)
-                # 複数: 画面下に表示してキー待ち
-                print("", flush=True)
-                for ln in lines_out:
-                    print(ln)
-                self.term.color(4)
-                print("[ Hit any key ]", end='', flush=True)
-                Terminal.getch()
-                self.term.clear()
-                return -1
-            Terminal.getch()
-            self.term.locate(0, self.display.BOTTOMLN)
-            print(" " * 80, end='', flush=True)
+            self._show_lines(lines_out)
         return -1
 
+    HEXDUMP_CHUNK = 1 << 16     # hexdump で一度に書式化するバイト数(16の倍数)
+
+    def hexdump_blocks(self, start, end):
+        """範囲 [start..end] の16進ダンプを、改行付きの行をまとめた文字列の
+        ブロックとして順に返す(ジェネレータ)。
+        範囲の内側に丸ごと収まる行は HEXDUMP_CHUNK バイトずつ bytes.hex と
+        translate でまとめて書式化し、範囲の端の行と UTF-8 の先頭バイトを
+        含む行だけを _hexdump_row で1バイトずつ書式化する。"""
+        mem_len = len(self.memory.mem)
+        row = start - (start % 16)          # 16バイト境界へ丸める
+        lo = (start + 15) & ~15             # 丸ごと範囲内の最初の行
+        hi = min(end + 1, mem_len) & ~15    # 丸ごと範囲内の行の終わり
+        while row <= end:
+            if lo <= row < hi:
+                n = min(hi - row, self.HEXDUMP_CHUNK)
+                # 文字欄の多バイト文字のために最大3バイト先まで読んでおく
+                limit = min(row + n + 3, end + 1, mem_len)
+                yield self._hexdump_chunk(row, n, self.memory.mem[row:limit])
+                row += n
+            else:
+                yield self._hexdump_row(row, start, end, mem_len) + "\n"
+                row += 16
+
+    def _hexdump_chunk(self, row, n, buf):
+        """範囲内に丸ごと収まる n バイトの行の並びを hexdump の行にまとめる。
+        buf は先頭 n バイトの後に文字欄の先読みぶんを含む。"""
+        data = buf[:n]
+        hexs = data.hex(' ').upper()
+        off = g_partial.offset
+        if has_utf8_lead(data):
+            limit = len(buf)
+            ascs = [format_utf8_cells(buf, k, k + 16, limit) for k in range(0, n, 16)]
+        else:
+            glyphs = data.translate(GLYPH_TABLE).decode('ascii')
+            ascs = [glyphs[k:k + 16] for k in range(0, n, 16)]
+        lines = [f"{(row + k + off) & 0xffffffffffff:012X} {hexs[k * 3:k * 3 + 47]} {asc}"
+                 for k, asc in zip(range(0, n, 16), ascs)]
+        lines.append('')
+        return "\n".join(lines)
+
+    def _hexdump_row(self, row, start, end, mem_len):
+        """hexdump の1行を1バイトずつ書式化する(範囲の端の行や多バイト文字を含む行)。
+        文字欄の UTF-8 の文字は行末を越えて範囲の終わりまで読む。"""
+        file_addr = (row + g_partial.offset) & 0xffffffffffff
+        hexs = []
+        ascs = []
+        for i in range(16):
+            cur = row + i
+            if cur < start or cur > end:
+                hexs.append("  ")       # 指定範囲外の余白
+            elif cur >= mem_len:
+                hexs.append("~~")       # バッファ外
+            else:
+                b = self.memory.mem[cur] & 0xff
+                hexs.append(HEX_PAIRS[b])
+        i = 0
+        while i < 16:
+            cur = row + i
+            if cur < start or cur > end:
+                ascs.append(' ')
+                i += 1
+                continue
+            if cur >= mem_len:
+                ascs.append('~')
+                i += 1
+                continue
+            b = self.memory.mem[cur] & 0xff
+            if 0xc0 <= b <= 0xf7:
+                if   b <= 0xdf: nbytes = 2
+                elif b <= 0xef: nbytes = 3
+                else:           nbytes = 4
+                if cur + nbytes - 1 <= end and cur + nbytes <= mem_len:
+                    raw = bytes([self.memory.mem[cur + k] & 0xff for k in range(nbytes)])
+                    try:
+                        ch = raw.decode('utf-8')
+                        pad = '  ' if nbytes == 4 else ' '
+                        ascs.append(ch + pad)
+                        i += nbytes
+                        continue
+                    except Exception:
+                        pass
+            ascs.append(GLYPHS[b])
+            i += 1
+        hexstr = ' '.join(hexs)
+        return f"{file_addr:012X} {hexstr} {''.join(ascs)}"
+
     def cmd_hexdump(self, x, x2, xf, xf2):
         """16進ダンプ表示コマンド: [start],[end] h
 
@@ -2463,66 +4678,28 @@ class BiEditor:
         if end < start:
             start, end = end, start
 
-        lines_out = []
-        row = start - (start % 16)          # 16バイト境界へ丸める
-        while row <= end:
-            file_addr = (row + g_partial.offset) & 0xffffffffffff
-            hexs = []
-            ascs = []
-            for i in range(16):
-                cur = row + i
-                if cur < start or cur > end:
-                    hexs.append("  ")       # 指定範囲外の余白
-                elif cur >= mem_len:
-                    hexs.append("~~")       # バッファ外
-                else:
-                    b = self.memory.mem[cur] & 0xff
-                    hexs.append(f"{b:02X}")
-            i = 0
-            while i < 16:
-                cur = row + i
-                if cur < start or cur > end:
-                    ascs.append(' ')
-                    i += 1
-                    continue
-                if cur >= mem_len:
-                    ascs.append('~')
-                    i += 1
-                    continue
-                b = self.memory.mem[cur] & 0xff
-                if 0xc0 <= b <= 0xf7:
-                    if   b <= 0xdf: nbytes = 2
-                    elif b <= 0xef: nbytes = 3
-                    else:           nbytes = 4
-                    if cur + nbytes - 1 <= end and cur + nbytes <= mem_len:
-                        raw = bytes([self.memory.mem[cur + k] & 0xff for k in range(nbytes)])
-                        try:
-                            ch = raw.decode('utf-8')
-                            pad = '  ' if nbytes == 4 else ' '
-                            ascs.append(ch + pad)
-                            i += nbytes
-                            continue
-                        except Exception:
-                            pass
-                ascs.append(chr(b) if 0x20 <= b <= 0x7e else '.')
-                i += 1
-            hexstr = ' '.join(hexs) 
-            lines_out.append(f"{file_addr:012X} {hexstr} {''.join(ascs)}")
-            row += 16
-
+        header = "             +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F 0123456789ABCDEF"
         if self.scriptingflag:
-            print("             +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F 0123456789ABCDEF")
-            for ln in lines_out:
-                print(ln)
+            # 行ごとに print せず、まとめて書式化したブロック単位で書き出す。
+            # 読み手のパイプが閉じたら残りは捨てて後続のコマンドを続ける。
+            try:
+                sys.stdout.write(header + "\n")
+                for block in self.hexdump_blocks(start, end):
+                    sys.stdout.write(block)
+                sys.stdout.flush()
+            except BrokenPipeError:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+                os.close(devnull)
             return
 
         # 対話モード: 画面はクリアせず、最下行からシアンで表示してキー待ち
         self.term.locate(0, self.display.BOTTOMLN + 1)
         self.term.color(4)          # シアン (coltab[5]=96)
-        print("             +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F 0123456789ABCDEF")
+        print(header)
         self.term.color(5)          # シアン (coltab[5]=96)
-        for ln in lines_out:
-            print(ln)
+        for block in self.hexdump_blocks(start, end):
+            print(block, end='')
         self.term.color(4)
         print("[ hit a key ]", end='', flush=True)
         Terminal.getch()
@@ -2537,6 +4714,9 @@ class BiEditor:
             rest = line[idx + 1:]
             if rest in ('s', 'i', 'l', 'q', 'f', 'd', 'Q', 'us', 'ui', 'ul'):
                 return self.cmd_typed_display(x, x2, xf, xf2, rest)
+            # 型付き数値の統計 (?=f, ?=s*16 など)
+            if rest.startswith('='):
+                return self.cmd_typed_stats(x, x2, xf, xf2, rest[1:])
 
         # 16進ダンプ: [start],[end] h
         if idx < len(line) and line[idx] == 'h':
@@ -2721,14 +4901,6 @@ class BiEditor:
 
             if not self._check_op_range(x, x2):
                 return -1
-            # 破綻点修正: times(繰り返し回数)に上限が無く、Pythonレベルの
-            # ループで1回ごとにsetmem()/readmem()を呼ぶ実装のため、現実的な
-            # 大きさの値でも極端に遅くなっていた(例: 2バイト範囲でも
-            # times=100000で3秒以上)。compareコマンドのFCMP_MAXNと同様の
-            # 上限を設ける。
-            if times > self.MAX_SHIFT_TIMES:
-                self.stderr(f"Repeat count too large (max {self.MAX_SHIFT_TIMES}).")
-                return -1
 
             self.save_undo_state()
             self.shift_rotate(x, x2, times, bit, multibyte, ch)
@@ -3144,7 +5316,6 @@ class BiEditor:
         return -1
     
     # 各種操作メソッド
-    MAX_SHIFT_TIMES = 8192  # シフト/ローテートの繰り返し回数上限(compare の FCMP_MAXN に倣う)
     # 破綻点修正: i/I コマンドの "*N" 明示的繰り返しや範囲指定fillモードは、
     # data = m * length のようにNをそのまま乗じるため上限が無く、桁を1つ
     # 打ち間違えるだけで(例: "0i 41*99999999999")数百GB相当のメモリ確保を
@@ -3168,24 +5339,30 @@ class BiEditor:
             return False
         return True
 
+    def _translate_range(self, x, x2, table):
+        """[x, x2] の各バイトを 256 バイトの変換表 table で一括変換し、
+        1 回の ovwmem で書き戻す(undo には ovw_region 1件だけが載る)。
+        1バイトずつ readmem/setmem する旧実装は範囲長に比例した回数の
+        Python 呼び出しと undo エントリを生んでいた。"""
+        self.memory.ovwmem(x, self.memory.mem[x:x2 + 1].translate(table))
+
     def opeand(self, x, x2, x3):
-        for i in range(x, x2 + 1):
-            self.memory.setmem(i, self.memory.readmem(i) & (x3 & 0xff))
+        v = x3 & 0xff
+        self._translate_range(x, x2, bytes(b & v for b in range(256)))
         self.stdmm(f"{x2 - x + 1} bytes anded.")
     
     def opeor(self, x, x2, x3):
-        for i in range(x, x2 + 1):
-            self.memory.setmem(i, self.memory.readmem(i) | (x3 & 0xff))
+        v = x3 & 0xff
+        self._translate_range(x, x2, bytes(b | v for b in range(256)))
         self.stdmm(f"{x2 - x + 1} bytes ored.")
     
     def opexor(self, x, x2, x3):
-        for i in range(x, x2 + 1):
-            self.memory.setmem(i, self.memory.readmem(i) ^ (x3 & 0xff))
+        v = x3 & 0xff
+        self._translate_range(x, x2, bytes(b ^ v for b in range(256)))
         self.stdmm(f"{x2 - x + 1} bytes xored.")
     
     def openot(self, x, x2):
-        for i in range(x, x2 + 1):
-            self.memory.setmem(i, (~(self.memory.readmem(i)) & 0xff))
+        self._translate_range(x, x2, bytes(~b & 0xff for b in range(256)))
         self.stdmm(f"{x2 - x + 1} bytes noted.")
     
     def movmem(self, start, end, dest):
@@ -3211,94 +5388,50 @@ class BiEditor:
         return xp
     
     def shift_rotate(self, x, x2, times, bit, multibyte, direction):
-        """シフト・ローテート操作"""
-        for i in range(times):
-            if not multibyte:
-                if bit == Parser.UNKNOWN:
-                    if direction == '<':
-                        self.left_rotate_byte(x, x2)
-                    else:
-                        self.right_rotate_byte(x, x2)
-                else:
-                    if direction == '<':
-                        self.left_shift_byte(x, x2, bit & 1)
-                    else:
-                        self.right_shift_byte(x, x2, bit & 1)
-            else:
-                if bit == Parser.UNKNOWN:
-                    if direction == '<':
-                        self.left_rotate_multibyte(x, x2)
-                    else:
-                        self.right_rotate_multibyte(x, x2)
-                else:
-                    if direction == '<':
-                        self.left_shift_multibyte(x, x2, bit & 1)
-                    else:
-                        self.right_shift_multibyte(x, x2, bit & 1)
-    
-    def left_shift_byte(self, x, x2, c):
-        for i in range(x, x2 + 1):
-            self.memory.setmem(i, (self.memory.readmem(i) << 1) | (c & 1))
-    
-    def right_shift_byte(self, x, x2, c):
-        for i in range(x, x2 + 1):
-            self.memory.setmem(i, (self.memory.readmem(i) >> 1) | ((c & 1) << 7))
-    
-    def left_rotate_byte(self, x, x2):
-        for i in range(x, x2 + 1):
-            m = self.memory.readmem(i)
-            c = (m & 0x80) >> 7
-            self.memory.setmem(i, (m << 1) | c)
-    
-    def right_rotate_byte(self, x, x2):
-        for i in range(x, x2 + 1):
-            m = self.memory.readmem(i)
-            c = (m & 0x01) << 7
-            self.memory.setmem(i, (m >> 1) | c)
+        """シフト・ローテート操作。
+
+        times 回ぶんの結果を1パスで求め、範囲を1回の ovwmem で書き戻す。
+        ローテートは幅で剰余を取った回転量で1回回すのと、シフトは幅で
+        頭打ちしたビット数で1回ずらすのと同じ結果になる(あふれたビットは
+        捨てられ、空いたビットは毎回同じ bit で埋まるため)。範囲全体を
+        times 回なめる旧実装と違い、回数に上限を設ける必要がない。
+        """
+        if times == 0:
+            return
+        if not multibyte:
+            table = bytes(self._shift_value(b, 8, times, bit, direction) for b in range(256))
+            self._translate_range(x, x2, table)
+        else:
+            v = self.get_multibyte_value(x, x2)
+            width = (x2 - x + 1) * 8
+            self.put_multibyte_value(x, x2, self._shift_value(v, width, times, bit, direction))
+
+    @staticmethod
+    def _shift_value(v, width, times, bit, direction):
+        """width ビットの値 v を、bit 未指定ならローテート、bit 指定なら
+        空きを bit(0/1) で埋めるシフトとして times 回ずらした値を返す"""
+        mask = (1 << width) - 1
+        if bit == Parser.UNKNOWN:
+            n = times % width
+            if direction == '<':
+                return ((v << n) | (v >> (width - n))) & mask
+            return ((v >> n) | (v << (width - n))) & mask
+        n = min(times, width)
+        fill = mask if bit & 1 else 0
+        if direction == '<':
+            return ((v << n) | (fill >> (width - n))) & mask
+        return (v >> n) | (fill ^ (fill >> n))
     
     def get_multibyte_value(self, x, x2):
-        v = 0
-        be = (self.endian == 'big')
-        if be:
-            # ビッグエンディアン: x が MSB
-            for i in range(x, x2 + 1):
-                v = (v << 8) | self.memory.readmem(i)
-        else:
-            # リトルエンディアン: x が LSB
-            for i in range(x2, x - 1, -1):
-                v = (v << 8) | self.memory.readmem(i)
-        return v
+        # エンディアンに従い [x, x2] を1つの整数として読む
+        # (ビッグエンディアン: x が MSB / リトルエンディアン: x が LSB)
+        data = self.memory.mem[x:x2 + 1].ljust(x2 - x + 1, b'\0')
+        return int.from_bytes(data, self.endian)
     
     def put_multibyte_value(self, x, x2, v):
-        be = (self.endian == 'big')
-        if be:
-            # ビッグエンディアン: x2 から x へ LSB → MSB の順で書き戻す
-            for i in range(x2, x - 1, -1):
-                self.memory.setmem(i, v & 0xff)
-                v >>= 8
-        else:
-            # リトルエンディアン: x から x2 へ LSB → MSB の順で書き戻す
-            for i in range(x, x2 + 1):
-                self.memory.setmem(i, v & 0xff)
-                v >>= 8
-    
-    def left_shift_multibyte(self, x, x2, c):
-        v = self.get_multibyte_value(x, x2)
-        self.put_multibyte_value(x, x2, (v << 1) | c)
-    
-    def right_shift_multibyte(self, x, x2, c):
-        v = self.get_multibyte_value(x, x2)
-        self.put_multibyte_value(x, x2, (v >> 1) | (c << ((x2 - x) * 8 + 7)))
-    
-    def left_rotate_multibyte(self, x, x2):
-        v = self.get_multibyte_value(x, x2)
-        c = 1 if v & (1 << ((x2 - x) * 8 + 7)) else 0
-        self.put_multibyte_value(x, x2, (v << 1) | c)
-    
-    def right_rotate_multibyte(self, x, x2):
-        v = self.get_multibyte_value(x, x2)
-        c = 1 if v & 0x1 else 0
-        self.put_multibyte_value(x, x2, (v >> 1) | (c << ((x2 - x) * 8 + 7)))
+        # get_multibyte_value の逆。幅に収まらない上位ビットは捨てる
+        n = x2 - x + 1
+        self.memory.ovwmem(x, (v & ((1 << (n * 8)) - 1)).to_bytes(n, self.endian))
 
     def scommand(self, start, end, xf, xf2, line, idx):
         """置換コマンド
@@ -3321,8 +5454,8 @@ class BiEditor:
                 m, idx = self.parser.get_restr(line, idx)
                 self.search.regexp = True
                 self.search.remem = m
-                # span はマッチ実行後に hitre() が更新するため、ここでは 1 以上の仮値を設定して
-                # 「検索対象あり」チェックだけ通す。実際の削除幅は searchnextnoloop 後に使う self.search.span で決まる。
+                # 正規表現のマッチ幅は一定でないため、ここでは 1 以上の仮値を設定して
+                # 「検索対象あり」チェックだけ通す。実際の削除幅は collect_matches が返す各マッチの長さで決まる。
                 self.search.span = max(1, len(m))
             elif idx < len(line) and line[idx] == '/':
                 self.search.smem, idx = self.parser.get_hexs(line, idx + 1)
@@ -3340,79 +5473,25 @@ class BiEditor:
             return
         
         n, idx = self.parser.get_str_or_hexs(line, idx)
-        
-        i = start
-        cnt = 0
-        self.display.jump(i)
-        
-        while True:
-            f = self.searchnextnoloop(self.display.fpos())
-            
-            i = self.display.fpos()
-            
-            if f < 0:
-                # 検索エラー: それまでの置換分をコミット（0 件なら commit_undo が自動で no-op にする）
-                self.commit_undo()
-                return
-            elif i <= end and f == 1:
-                # ゼロ幅正規表現マッチ (例: a* / x? が空文字列にマッチ) は
-                # 置換幅 0 のため delmem が no-op となり、検索位置も前進せず
-                # 無限ループ／暴走挿入に陥る。幅 0 のときは何もせず停止する。
-                if self.search.regexp and self.search.span == 0:
-                    self.display.jump(pos)
-                    self.commit_undo()
-                    self.stdmm(f"  {cnt} times replaced.")
-                    return
-                # 今回のヒット幅を確定（regex は hitre が span を都度更新する）
-                span_here = self.search.span
-                self.memory.delmem(i, i + span_here - 1, False, self.memory.yankmem)
-                self.memory.insmem(i, n)
-                # 置換でバッファ長が len(n)-span_here だけ変化し、以降の
-                # 位置がその分ずれる。走査範囲の終端 end も同量ずらして
-                # 元の論理範囲を保つ（伸長時に途中で打ち切られる不具合の修正）。
-                end += len(n) - span_here
-                pos = i + len(n)
-                cnt += 1
-                i = pos
-                self.display.jump(i)
-            else:
-                self.display.jump(pos)
-                self.commit_undo()   # 全置換完了でコミット
-                self.stdmm(f"  {cnt} times replaced.")
-                return
-    
-    def searchnextnoloop(self, fp):
-        """ループしない検索"""
-        cur_pos = fp
 
-        if not self.search.regexp and not self.search.smem:
-            return 0
-        # 呼び出し元(scommand)は置換のたびにバッファを書き換えて再度呼ぶため、
-        # 毎回キャッシュを作り直して新しいバッファ内容に対して探索する。
-        self.search.begin_scan()
+        # マッチは置換前のバッファに対して1回の走査でまとめて求め、
+        # 置換結果も1回で差し替える(ヒットごとに再検索・delmem/insmem
+        # していた旧実装はヒット数に対して二乗の時間がかかっていた)。
         self.stdmm_wait("Wait.")
-        while True:
-            if self.search.regexp:
-                f = self.search.hitre(cur_pos)
-            else:
-                f = self.search.hit(cur_pos)
-            
-            if f == 1:
-                self.display.jump(cur_pos)
-                self.display.clrmm()
-                return 1
-            
-            elif f < 0:
-                self.display.clrmm()
-                return -1
-            
-            cur_pos += 1
-            
-            if cur_pos >= len(self.memory.mem):
-                self.display.jump(len(self.memory.mem))
-                self.display.clrmm()
-                return 0
-    
+        hits = self.search.collect_matches(start, end)
+        self.display.clrmm()
+        if hits is None:
+            # 検索エラー: 変更なしで終了
+            self.commit_undo()
+            return
+        if hits:
+            self.memory.submem(hits, n)
+            # 最後の置換の直後(置換後の座標)へカーソルを置く
+            pos = hits[-1][0] + len(n) + sum(len(n) - l for _, l in hits[:-1])
+        self.display.jump(pos)
+        self.commit_undo()   # 全置換完了でコミット
+        self.stdmm(f"  {len(hits)} times replaced.")
+
     def scripting(self, scriptfile):
         """スクリプト実行"""
         try:
@@ -3436,6 +5515,30 @@ class BiEditor:
         return 0
 
 
+def format_size(n):
+    """バイト数を 1.5M のような短い表記にする (parse_size の逆)"""
+    for unit in ('', 'K', 'M', 'G'):
+        if n < 1024 or unit == 'G':
+            return f"{n}{unit}" if isinstance(n, int) else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+def parse_size(s):
+    """'4096', '64K', '256M', '1G' のようなサイズ指定をバイト数にする"""
+    s = s.strip().upper()
+    mult = 1
+    if s and s[-1] in 'KMG':
+        mult = 1 << (10 * ('KMG'.index(s[-1]) + 1))
+        s = s[:-1]
+    try:
+        v = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {s!r}") from None
+    if v < 0:
+        raise argparse.ArgumentTypeError("size must not be negative")
+    return v * mult
+
+
 def _emergency_save_path(original_file):
     """緊急保存用のパスを決定する。既存ファイルを絶対に上書きしない。"""
     base = f"{original_file}.save" if original_file else "bi.save"
@@ -3460,6 +5563,14 @@ def _emergency_save(editor, original_file):
         return None
 
 
+def _journal_kept(editor):
+    """永続 undo ジャーナルが記録を続けていればそのパス、なければ None"""
+    hist = editor.undo_history
+    if hist is None or hist.failed:
+        return None
+    return hist.path
+
+
 def main():
     """メイン関数"""
     ap = argparse.ArgumentParser(
@@ -3483,6 +5594,19 @@ def main():
                     metavar='END', help='partial edit: end offset inclusive (hex)')
     ap.add_argument('-c', '--command', type=str, default=None, metavar='COMMAND',
                     help='execute a single bi command non-interactively, then exit')
+    ap.add_argument('-m', '--mmap', choices=('auto', 'on', 'off'), default='auto',
+                    help="map the file read-only instead of reading it into memory: 'on' always, 'off' never, "
+                         "'auto' (default) for files of 64 MiB or more")
+    ap.add_argument('--fps', type=int, default=30, metavar='N',
+                    help='redraw at most N times per second while keys are queued '
+                         '(default 30; 0 = only when input stops)')
+    ap.add_argument('--undo-budget', type=parse_size, default=BiEditor.DEFAULT_UNDO_BUDGET,
+                    metavar='SIZE',
+                    help='memory for undo/redo data before older steps are moved to a temporary '
+                         'file, e.g. 64M or 1G (default 256M)')
+    ap.add_argument('--undo-journal', action='store_true',
+                    help='keep undo history in <file>.undo so that u/U reach back into earlier '
+                         'sessions and unsaved changes are recovered after a crash')
     args = ap.parse_args()
 
     # パーシャルモードの判定・長さ計算
@@ -3510,7 +5634,10 @@ def main():
     # エディタの初期化
     editor = BiEditor(termcol=args.termcolor)
     editor.filemgr.filename = args.file
+    editor.filemgr.mmap_mode = args.mmap
     editor.verbose = args.verbose
+    editor.max_fps = args.fps
+    editor.undo_budget = args.undo_budget
 
     # 非対話モード判定（-s スクリプト または -c コマンド）
     noninteractive = bool(args.script) or (args.command is not None)
@@ -3533,8 +5660,20 @@ def main():
     elif msg:
         editor.stdmm(msg)
 
+    # 永続 undo ジャーナル。開けなくても編集は続ける。
+    if args.undo_journal:
+        if partial_mode:
+            editor.stderr("--undo-journal is not available in partial mode.")
+        else:
+            ok, jmsg = editor.open_undo_history(f"{args.file}.undo")
+            if not ok:
+                editor.stderr(jmsg)
+            elif jmsg:
+                editor.stdmm(jmsg)
+
     # スクリプト/コマンド実行、またはインタラクティブモード
     exit_code = 0
+    crashed = False
     try:
         if noninteractive:
             if args.script:
@@ -3558,6 +5697,8 @@ def main():
                     ok, wmsg = editor.filemgr.writefile_partial(args.file)
                 else:
                     ok, wmsg = editor.filemgr.writefile(args.file)
+                    if ok:
+                        editor.note_write(args.file)
                 if ok:
                     if editor.verbose:
                         print(wmsg)
@@ -3568,17 +5709,28 @@ def main():
             if editor.error_occurred:
                 exit_code = 1
         else:
-            editor.fedit()
+            with Terminal.raw_mode():
+                editor.fedit()
     except KeyboardInterrupt:
         # Ctrl+C: 端末復帰は finally に任せ、変更があれば退避保存する。
+        # 永続ジャーナルがあれば次に開いたときそこから復元する。
+        crashed = True
         if editor.memory.lastchange:
-            saved = _emergency_save(editor, args.file)
-            if saved:
-                print(f"\nInterrupted. memory saved to {saved}.", file=sys.stderr)
+            kept = _journal_kept(editor)
+            if kept:
+                print(f"\nInterrupted. changes kept in {kept}.", file=sys.stderr)
+            else:
+                saved = _emergency_save(editor, args.file)
+                if saved:
+                    print(f"\nInterrupted. memory saved to {saved}.", file=sys.stderr)
         exit_code = 130
     except Exception as exc:
-        saved = _emergency_save(editor, args.file)
-        if saved:
+        crashed = True
+        kept = _journal_kept(editor)
+        saved = None if kept else _emergency_save(editor, args.file)
+        if kept:
+            editor.stderr(f"Some error occured ({exc}). changes kept in {kept}.")
+        elif saved:
             editor.stderr(f"Some error occured ({exc}). memory saved to {saved}.")
         else:
             editor.stderr(f"Some error occured ({exc}). emergency save also failed.")
@@ -3590,6 +5742,7 @@ def main():
         editor.term.color(7)
         editor.term.dispcursor()
         editor.term.locate(0, editor.display.BOTTOMLN+1)
+        editor.close_undo_history(clean=not crashed)
 
     if exit_code:
         sys.exit(exit_code)
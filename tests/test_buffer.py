@@ -0,0 +1,86 @@
+"""PieceTable と MemoryBuffer.submem の振る舞い"""
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BI = os.path.join(ROOT, 'bi.py')
+sys.path.insert(0, ROOT)
+
+import bi  # noqa: E402
+
+
+@pytest.mark.parametrize('block', [2, 4, bi.PieceTable.BLOCK])
+@pytest.mark.parametrize('seed', range(20))
+def test_piece_table_matches_bytearray(monkeypatch, block, seed):
+    # ブロック境界をまたぐ編集が起きるよう、小さいブロックでも試す
+    monkeypatch.setattr(bi.PieceTable, 'BLOCK', block)
+    r = random.Random(seed)
+    ref = bytearray(r.choice(b'abc') for _ in range(r.randrange(0, 80)))
+    mem = bi.PieceTable(bytes(ref))
+    for _ in range(200):
+        a = r.randrange(0, len(ref) + 1)
+        b = r.randrange(a, len(ref) + 1)
+        op = r.randrange(4)
+        if op == 0:
+            data = bytes(r.choice(b'abcd') for _ in range(r.randrange(0, 5)))
+            ref[a:b] = data
+            mem[a:b] = data
+        elif op == 1:
+            del ref[a:b]
+            del mem[a:b]
+        elif op == 2 and ref:
+            i = r.randrange(len(ref))
+            ref[i] = mem[i] = r.randrange(256)
+        else:
+            data = bytes(r.choice(b'ab') for _ in range(r.randrange(1, 4)))
+            ref += data
+            mem += data
+        assert len(mem) == len(ref)
+        assert mem[a:b + 3] == bytes(ref[a:b + 3])
+        sub = bytes(r.choice(b'abc') for _ in range(r.randrange(0, 4)))
+        assert mem.find(sub, a) == ref.find(sub, a)
+        assert mem.rfind(sub, 0, b) == ref.rfind(sub, 0, b)
+    assert mem.tobytes() == bytes(ref)
+    assert b''.join(mem.iter_chunks(size=7)) == bytes(ref)
+
+
+def test_changed_since_covers_edits():
+    mem = bi.PieceTable(b'0123456789')
+    v = mem.version
+    mem[2:4] = b'ab'
+    mem[8:8] = b'xyz'
+    a, b, n = mem.changed_since(v)
+    before = b'0123456789'
+    after = mem.tobytes()
+    assert before[:a] == after[:a]
+    assert before[b:] == after[a + n:]
+
+
+def test_submem_records_one_entry():
+    memory = bi.MemoryBuffer()
+    memory.mem = bi.PieceTable(b'ab' * 1000)
+    hits = [(i, 1) for i in range(0, 2000, 2)]
+    memory.begin_diff()
+    memory.submem(hits, b'XYZ')
+    log = memory.end_diff()
+    assert memory.mem.tobytes() == b'XYZb' * 1000
+    assert [entry[0] for entry in log] == ['sub']
+
+
+def test_submem_is_undone_at_once(tmp_path):
+    data = b'abc' * 3000
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    replaced = tmp_path / 'replaced.bin'
+    undone = tmp_path / 'undone.bin'
+    script = tmp_path / 'sub.bi'
+    script.write_text(f's /b/XY\nw {replaced}\nu\nw {undone}\n')
+    p = subprocess.run([sys.executable, BI, str(path), '-s', str(script)],
+                       capture_output=True, text=True)
+    assert p.returncode == 0, p.stdout + p.stderr
+    assert replaced.read_bytes() == b'aXYc' * 3000
+    assert undone.read_bytes() == data
@@ -0,0 +1,78 @@
+"""@ (exec) / {} (eval) から見える mem[] の振る舞い"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BI = os.path.join(ROOT, 'bi.py')
+sys.path.insert(0, ROOT)
+
+import bi  # noqa: E402
+
+
+def run_bi(tmp_path, data, *commands):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    for command in commands:
+        p = subprocess.run([sys.executable, BI, str(path), '-c', command],
+                           capture_output=True, text=True)
+        assert p.returncode == 0, p.stdout + p.stderr
+    return path.read_bytes()
+
+
+@pytest.mark.parametrize('command, expected', [
+    ('@mem=mem+b"Q"', b'abcabcQ'),
+    ('@mem=bytearray(b"xyz")+mem', b'xyzabcabc'),
+    ('@mem=b"Q"+mem', b'Qabcabc'),
+    ('@mem=mem.replace(b"a",b"Z")', b'ZbcZbc'),
+    ('@import re; mem[:]=re.sub(rb"a",b"Q",mem)', b'QbcQbc'),
+    ('@mem[1:3]=b""', b'aabc'),
+    ('@mem[0]=0x41', b'Abcabc'),
+    ('@setmem(7,0x42)', b'abcabc\x00B'),
+    ('@mem=list(mem)+[0x43]', b'abcabcC'),
+    ('@x=mem[5]; mem[0]=x; mem+=b"Q"', b'cbcabcQ'),
+    ('{mem.index(b"c")+mem.count(b"a")}i 41', b'abcaAc'),
+])
+def test_mem_sequence_idioms(tmp_path, command, expected):
+    assert run_bi(tmp_path, b'abcabc', command) == expected
+
+
+@pytest.mark.parametrize('code, mode, expected', [
+    ('setmem(0, 0x41)', 'exec', False),
+    ('f = setmem', 'exec', False),
+    ('x = mem[5]', 'exec', False),
+    ('mem[1:3] = b""; del mem[0]', 'exec', False),
+    ('mem += b"Q"; n = len(mem)', 'exec', False),
+    ('mem = b"abc"', 'exec', False),
+    ('mem = mem + b"Q"', 'exec', True),
+    ('mem = mem.replace(b"a", b"Z")', 'exec', True),
+    ('import re; mem[:] = re.sub(rb"a", b"Q", mem)', 'exec', True),
+    ('mem[3] + cp', 'eval', False),
+    ('mem.index(b"c")', 'eval', True),
+])
+def test_mem_needs_bytes(code, mode, expected):
+    assert bi._mem_needs_bytes(code, mode) is expected
+
+
+def test_exec_change_is_undoable(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'abcabc')
+    script = tmp_path / 'undo.bi'
+    script.write_text('@mem=mem.replace(b"a",b"Z")\n@mem=b"Q"+mem\nu\nu\nU\n')
+    p = subprocess.run([sys.executable, BI, str(path), '-s', str(script), '-w'],
+                       capture_output=True, text=True)
+    assert p.returncode == 0, p.stdout + p.stderr
+    assert path.read_bytes() == b'ZbcZbc'
+
+
+def test_failed_exec_keeps_partial_change(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'abc')
+    script = tmp_path / 'fail.bi'
+    script.write_text('@mem+=b"d"; 1/0\nw\n')
+    p = subprocess.run([sys.executable, BI, str(path), '-s', str(script)],
+                       capture_output=True, text=True)
+    assert 'python exec() error' in p.stdout + p.stderr
+    assert path.read_bytes() == b'abcd'
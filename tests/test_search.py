@@ -0,0 +1,96 @@
+"""一致表の部分修復と窓ごとの正規表現検索"""
+import os
+import random
+import re
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bi  # noqa: E402
+
+
+class Display:
+    def stdmm(self, *args):
+        pass
+
+    def stdmm_wait(self, *args):
+        pass
+
+    def clrmm(self):
+        pass
+
+
+def engine(data, pattern, window=4):
+    memory = bi.MemoryBuffer()
+    memory.mem = bi.PieceTable(data)
+    se = bi.SearchEngine(memory, Display())
+    se.RE_WINDOW = window
+    if isinstance(pattern, str):
+        se.regexp = True
+        se.remem = pattern
+    else:
+        se.smem = list(pattern)
+    return se
+
+
+def expected_table(data, pattern):
+    if isinstance(pattern, str):
+        starts, spans = [], []
+        for m in re.finditer(pattern.encode(), data):
+            if not starts or starts[-1] != m.start():
+                starts.append(m.start())
+                spans.append(m.end() - m.start())
+        return starts, spans
+    starts, pos = [], 0
+    while (pos := data.find(pattern, pos)) >= 0:
+        starts.append(pos)
+        pos += len(pattern)
+    return starts, [len(pattern)] * len(starts)
+
+
+@pytest.mark.parametrize('pattern', [
+    'ab', 'a[bc]a', r'b\b', 'c$', '^a', b'ab', b'aba',
+])
+@pytest.mark.parametrize('seed', range(30))
+def test_repaired_table_matches_fresh_scan(monkeypatch, pattern, seed):
+    r = random.Random(seed)
+    data = bytes(r.choice(b'abc\n') for _ in range(r.randrange(1, 200)))
+    se = engine(data, pattern)
+    assert se._match_table() is not None
+    repaired = []
+    repair = se._repair_table
+    monkeypatch.setattr(se, '_repair_table',
+                        lambda *args: repaired.append(1) or repair(*args))
+    for _ in range(5):
+        a = r.randrange(0, len(data))
+        b = r.randrange(a, min(len(data), a + 4) + 1)
+        new = bytes(r.choice(b'abc\n') for _ in range(r.randrange(0, 4)))
+        se.memory.mem[a:b] = new
+        data = data[:a] + new + data[b:]
+        starts, spans, complete = se._match_table()
+        assert complete
+        assert (starts, spans) == expected_table(data, pattern)
+    assert repaired
+
+
+@pytest.mark.parametrize('pattern', ['ab', 'a.b', r'b\b', 'c$', '^a', '(?<=a)b'])
+@pytest.mark.parametrize('seed', range(30))
+def test_regex_next_and_last(pattern, seed):
+    r = random.Random(seed)
+    data = bytes(r.choice(b'abc\n') for _ in range(r.randrange(1, 120)))
+    se = engine(data, pattern, window=r.choice([1, 3, 4096]))
+    # 編集して複数のピースに分け、連結せずに探す経路を通す
+    for _ in range(r.randrange(1, 6)):
+        k = r.randrange(len(data))
+        se.memory.mem[k:k + 1] = b'ba'
+        data = data[:k] + b'ba' + data[k + 1:]
+    n = len(data)
+    starts = [i for i in range(n) if re.compile(pattern.encode()).match(data, i)]
+    fp = r.randrange(n)
+    after = [i for i in starts if i >= fp] or [i for i in starts if i < fp]
+    assert se.searchnext(fp, n) == (after[0] if after else None)
+    before = [i for i in starts if i <= fp] or [i for i in starts if i > fp]
+    assert se.searchlast(fp, n) == (before[-1] if before else None)
@@ -0,0 +1,44 @@
+"""--undo-journal: 異常終了したセッションの編集の復元"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BI = os.path.join(ROOT, 'bi.py')
+
+
+def run_bi(path, *args):
+    p = subprocess.run([sys.executable, BI, str(path), '--undo-journal', *args],
+                       capture_output=True, text=True, cwd=path.parent)
+    assert p.returncode == 0, p.stdout + p.stderr
+    return p.stdout + p.stderr
+
+
+def test_recovers_changes_after_crash(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'abcdef')
+    run_bi(path, '-c', '0,1 d', '-w')
+    assert path.read_bytes() == b'cdef'
+    # os._exit() で終わるので正常終了の印 (Q) が残らない
+    script = tmp_path / 'crash.bi'
+    script.write_text('0i 41 42\n3I 43\n2I 44\nu\n@import os; os._exit(0)\n')
+    run_bi(path, '-s', str(script))
+    assert path.read_bytes() == b'cdef'
+
+    out = run_bi(path, '-v', '-c', 'w')
+    assert "Recovered 2 changes from undo journal" in out
+    assert 'Undo.' not in out and 'Redo.' not in out
+    assert path.read_bytes() == b'ABeCf'
+
+    # 復元した変更は undo できる
+    run_bi(path, '-c', 'u', '-w')
+    assert path.read_bytes() == b'ABef'
+
+
+def test_clean_exit_does_not_replay(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'abcdef')
+    run_bi(path, '-c', '0i 41', '-w')
+    out = run_bi(path, '-v', '-c', 'w')
+    assert 'Recovered' not in out
+    assert path.read_bytes() == b'Abcdef'